@@ -3,10 +3,109 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.transforms import Compose, ToPILImage, ToTensor
+from torch.nn.modules.utils import _pair
 from scipy.stats import truncnorm
 import cv2
 
 
+def _gather(x, rows, cols):
+    # per-frame crop: x is NxCxHxW, rows is NxTh and cols is NxTw, returns NxCxThxTw
+    n = torch.arange(len(x), device=x.device)[:, None, None]
+    return x[n, :, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+
+def _affected(start, size, kernel, stride, padding, out_size):
+    # output positions whose receptive field overlaps [start, start + size), as one start per frame and
+    # a common length; starts are shifted back where needed so every tile fits in the output
+    first = (-(-(start + padding - kernel + 1) // stride)).clamp(min=0)
+    last = ((start + size - 1 + padding) // stride).clamp(max=out_size - 1)
+    length = max(int((last - first).max()) + 1, 1)
+    return first.clamp(max=out_size - length), length
+
+
+class IncrementalForward():
+    """Forward pass for frames that only differ from a set of clean frames inside a bounding box.
+
+    The clean activations are computed once. Each call only recomputes,
+    layer by layer, the output tiles inside the receptive field of the
+    bounding box of each frame and pastes them into the cached clean
+    activations before running the dense head. Forward and backward cost
+    then scale with the billboard instead of the frame. bboxes are
+    [x0, y0, x1, y1) pixel boxes, one per clean frame. Frames are batched
+    with a common tile size per layer, so frames with a smaller box
+    recompute a little more than they need to. Calling it with K*N frames
+    evaluates K perturbed copies of the N clean frames.
+    """
+
+    def __init__(self, model, clean, bboxes):
+        self.model = model
+        self.num_frames = len(clean)
+        device = clean.device
+        bboxes = torch.as_tensor(np.asarray(bboxes), dtype=torch.long, device=device)
+        h, w = clean.shape[2:]
+        # region of the current layer input that differs from the clean frames
+        th = max(int((bboxes[:, 3] - bboxes[:, 1]).max()), 1)
+        tw = max(int((bboxes[:, 2] - bboxes[:, 0]).max()), 1)
+        r0, c0 = bboxes[:, 1].clamp(0, h - th), bboxes[:, 0].clamp(0, w - tw)
+        self.input_rows = r0[:, None] + torch.arange(th, device=device)
+        self.input_cols = c0[:, None] + torch.arange(tw, device=device)
+        self.steps = []
+        x = clean
+        with torch.no_grad():
+            for layer in model.conv_stages():
+                if not isinstance(layer, (nn.Conv2d, nn.MaxPool2d)):
+                    # pointwise activation, the changed region stays the same
+                    self.steps.append((layer, None))
+                    x = layer(x)
+                    continue
+                if isinstance(layer.padding, str) or getattr(layer, "ceil_mode", False) or _pair(layer.dilation) != (1, 1):
+                    raise ValueError(f"Incremental inference does not support {layer}")
+                k, s, p = _pair(layer.kernel_size), _pair(layer.stride), _pair(layer.padding)
+                pad_value = float("-inf") if isinstance(layer, nn.MaxPool2d) else 0.0
+                y = layer(x)
+                o_r0, o_th = _affected(r0, th, k[0], s[0], p[0], y.shape[2])
+                o_c0, o_tw = _affected(c0, tw, k[1], s[1], p[1], y.shape[3])
+                # input window needed for the output tile, in padded input coordinates
+                rows = o_r0[:, None] * s[0] + torch.arange((o_th - 1) * s[0] + k[0], device=device)
+                cols = o_c0[:, None] * s[1] + torch.arange((o_tw - 1) * s[1] + k[1], device=device)
+                clean_window = _gather(F.pad(x, (p[1], p[1], p[0], p[0]), value=pad_value), rows, cols)
+                self.steps.append((layer, self._overlay(clean_window, rows - p[0], cols - p[1], r0, th, c0, tw)))
+                x, r0, th, c0, tw = y, o_r0, o_th, o_c0, o_tw
+            rows = torch.arange(x.shape[2], device=device).repeat(self.num_frames, 1)
+            cols = torch.arange(x.shape[3], device=device).repeat(self.num_frames, 1)
+            self.features = self._overlay(x, rows, cols, r0, th, c0, tw)
+
+    @staticmethod
+    def _overlay(clean_window, rows, cols, r0, th, c0, tw):
+        # where each window position reads from the recomputed tile, and which tile position it reads
+        tile_rows, tile_cols = rows - r0[:, None], cols - c0[:, None]
+        mask = ((tile_rows >= 0) & (tile_rows < th))[:, :, None] & ((tile_cols >= 0) & (tile_cols < tw))[:, None, :]
+        return clean_window, mask[:, None], tile_rows.clamp(0, th - 1), tile_cols.clamp(0, tw - 1)
+
+    @staticmethod
+    def _paste(tile, overlay, k):
+        clean_window, mask, rows, cols = overlay
+        if k > 1:
+            clean_window, mask = clean_window.repeat(k, 1, 1, 1), mask.repeat(k, 1, 1, 1)
+            rows, cols = rows.repeat(k, 1), cols.repeat(k, 1)
+        return torch.where(mask, _gather(tile, rows, cols), clean_window)
+
+    def __call__(self, x):
+        k = len(x) // self.num_frames
+        rows, cols = self.input_rows, self.input_cols
+        if k > 1:
+            rows, cols = rows.repeat(k, 1), cols.repeat(k, 1)
+        tile = _gather(x, rows, cols)
+        for layer, overlay in self.steps:
+            if overlay is None:
+                tile = layer(tile)
+            elif isinstance(layer, nn.Conv2d):
+                tile = F.conv2d(self._paste(tile, overlay, k), layer.weight, layer.bias, layer.stride, 0, 1, layer.groups)
+            else:
+                tile = F.max_pool2d(self._paste(tile, overlay, k), layer.kernel_size, layer.stride, 0)
+        return self.model.dense_head(self._paste(tile, self.features, k))
+
+
 # uses a ton of dropout layers between dense layers
 class DAVE2PytorchModel(nn.Module):
     def __init__(self, input_shape=(150, 200)):
@@ -34,17 +133,15 @@ class DAVE2PytorchModel(nn.Module):
             torch.nn.init.xavier_uniform_(m.weight)
             torch.nn.init.zeros_(m.bias)
 
+    def conv_stages(self):
+        return [self.conv1, F.elu, self.conv2, F.elu, self.conv3, F.elu, self.conv4, F.elu, self.conv5, F.elu]
+
     def forward(self, x):
-        x = self.conv1(x)
-        x = F.elu(x)
-        x = self.conv2(x)
-        x = F.elu(x)
-        x = self.conv3(x)
-        x = F.elu(x)
-        x = self.conv4(x)
-        x = F.elu(x)
-        x = self.conv5(x)
-        x = F.elu(x)
+        for layer in self.conv_stages():
+            x = layer(x)
+        return self.dense_head(x)
+
+    def dense_head(self, x):
         x = x.flatten(1)
         x = self.lin1(x)
         x = self.dropout(x)
@@ -60,6 +157,10 @@ class DAVE2PytorchModel(nn.Module):
         # x = 2 * torch.atan(x)
         return x
 
+    def incremental_forward(self, clean, bboxes):
+        # see IncrementalForward, for frames that only differ from clean inside bboxes
+        return IncrementalForward(self, clean, bboxes)
+
     def load(self, path="test-model.pt"):
         return torch.load(path)
 
@@ -175,17 +276,15 @@ class DAVE2v2(nn.Module):
             m.weight.data = torch.from_numpy(weights).float() / 10
             torch.nn.init.zeros_(m.bias)
 
+    def conv_stages(self):
+        return [self.conv1, F.relu, self.conv2, F.relu, self.conv3, F.relu, self.conv4, F.relu, self.conv5, F.relu]
+
     def forward(self, x):
-        x = self.conv1(x)
-        x = F.relu(x)
-        x = self.conv2(x)
-        x = F.relu(x)
-        x = self.conv3(x)
-        x = F.relu(x)
-        x = self.conv4(x)
-        x = F.relu(x)
-        x = self.conv5(x)
-        x = F.relu(x)
+        for layer in self.conv_stages():
+            x = layer(x)
+        return self.dense_head(x)
+
+    def dense_head(self, x):
         x = x.flatten(1)
         x = self.lin1(x)
         x = F.relu(x)
@@ -198,6 +297,10 @@ class DAVE2v2(nn.Module):
         # x = 2 * torch.atan(x)
         return x
 
+    def incremental_forward(self, clean, bboxes):
+        # see IncrementalForward, for frames that only differ from clean inside bboxes
+        return IncrementalForward(self, clean, bboxes)
+
     def load(self, path="test-model.pt"):
         return torch.load(path)
 
@@ -238,16 +341,15 @@ class DAVE2v3(nn.Module):
             torch.nn.init.xavier_uniform_(m.weight)
             torch.nn.init.zeros_(m.bias)
 
+    def conv_stages(self):
+        return [self.conv1, F.relu, self.pool1, self.conv2, F.relu, self.pool2, self.conv3, F.relu, self.pool3]
+
     def forward(self, x):
-        x = self.conv1(x)
-        x = F.relu(x)
-        x = self.pool1(x)
-        x = self.conv2(x)
-        x = F.relu(x)
-        x = self.pool2(x)
-        x = self.conv3(x)
-        x = F.relu(x)
-        x = self.pool3(x)
+        for layer in self.conv_stages():
+            x = layer(x)
+        return self.dense_head(x)
+
+    def dense_head(self, x):
         x = x.flatten(1)
         x = self.lin1(x)
         x = F.relu(x)
@@ -260,6 +362,10 @@ class DAVE2v3(nn.Module):
         x = self.lin4(x)
         return x
 
+    def incremental_forward(self, clean, bboxes):
+        # see IncrementalForward, for frames that only differ from clean inside bboxes
+        return IncrementalForward(self, clean, bboxes)
+
     def load(self, path="test-model.pt"):
         return torch.load(path)
 
@@ -1,6 +1,9 @@
 import random, math
 import sys, time
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import TrackGeometry
+from waypoints import WaypointFollower
 import os, copy
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import imshow
@@ -31,11 +34,11 @@ swerving=True
 swervingstdev = 3.5
 integral=0; prev_error=0
 steer_integral=0; steer_prev_error=0; steer_prev_setpoint = 0
-remaining_centerline = []
+follower = None
 centerline = []
 centerline_interpolated = []
 swerveline = []
-remaining_swerveline = []
+swerve_follower = None
 swervepoints_interpolated = []
 remaining_swervepoints = []
 roadleft = []
@@ -206,34 +209,6 @@ def setup_dir(training_dir):
         os.mkdir(training_dir)
     return "{}/data.csv".format(training_dir)
 
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-    # signed parallel distance components
-    # rowwise dot products of 2D vectors
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-    # perpendicular distance component
-    # rowwise cross products of 2D vectors
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 def turn_90(rot_quat):
     r = R.from_quat(list(rot_quat))
     r = r.as_euler('xyz', degrees=True)
@@ -406,10 +381,11 @@ def plot_trajectory2(traj, title="Trajectory", label1="AI behavior"):
     plt.pause(0.1)
 
 def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
-    global centerline, remaining_centerline, centerline_interpolated
-    global swerveline, remaining_swerveline, swervepoints_interpolated, remaining_swervepoints
+    global centerline, follower, centerline_interpolated
+    global swerveline, swerve_follower, swervepoints_interpolated, remaining_swervepoints
     global swervingstdev
-    actual_middle, adjusted_middle = road_analysis(bng)
+    track = TrackGeometry(default_scenario, spawnpoint, None, bng)
+    actual_middle, adjusted_middle = road_analysis(track)
     middle_end = adjusted_middle[:3]
     middle = adjusted_middle[3:]
     temp = [list(spawn['pos'])]; temp.extend(middle); middle = temp
@@ -440,43 +416,13 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
                 swerveline.append(p)
         swerveline.append(middle[0])
         # interpolate true centerline
-        centerline = []
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                centerline.extend([[x,y] for x,y in zip(xs,ys)])
-            else:
-                centerline.append([p[0],p[1]])
+        centerline = track.centerline(middle)[:, :2].tolist()
     else: # not swerving
-        # traj = []
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                # if swerving:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                # for x,y in zip(xs,ys):
-                centerline.extend([[x,y,p[2]] for x,y in zip(xs,ys)])
-                    # points.append([x, y, p[2]])
-                    # point_colors.append([0, 1, 0, 0.1])
-                    # spheres.append([x, y, p[2], 0.25])
-                    # sphere_colors.append([1, 0, 0, 0.8])
-            else:
-                centerline.append(copy.deepcopy(p))
-                # points.append([p[0], p[1], p[2]])
-                # point_colors.append([0, 1, 0, 0.1])
-                # spheres.append([p[0], p[1], p[2], 0.25])
-                # sphere_colors.append([1, 0, 0, 0.8])
-                # count += 1
+        centerline = track.centerline(middle).tolist()
+    track.save()
     plot_trajectory(swerveline, "Points on Script (Final)", "AI debug line")
-    remaining_centerline = copy.deepcopy(centerline)
-    remaining_swerveline = copy.deepcopy(swerveline)
+    follower = WaypointFollower(centerline)
+    swerve_follower = WaypointFollower(swerveline)
     centerline_interpolated = copy.deepcopy(centerline)
     # remaining_swervepoints = copy.deepcopy(swervepoints_interpolated)
     # for i in range(4):
@@ -554,52 +500,38 @@ def angle_between(next_waypoint, vehicle_state, reference_pt=None, title=None):
     return math.atan2(math.sin(inner_angle), math.cos(inner_angle)), inner_angle1
 
 def steering_setpoint(vehicle_state, traj=None):
-    global remaining_centerline, centerline, throttle_setpoint
+    global follower, centerline, throttle_setpoint
     global steer_integral, steer_prev_error, steer_prev_setpoint
     global tight_curve, avg_error
-    global swerveline, remaining_swerveline
+    global swerveline, swerve_follower
     # update next waypoint if you've reached your current one
     # normal driving circumstances
     # is there an upcoming tight curve?
     # shallow curve coming up soon
-    innerangle, innerangle1 = angle_between(remaining_swerveline[0], vehicle_state)
-    if not tight_curve and abs(innerangle) > (math.pi / 5):
-        tight_curve = True
-    else:
-        tight_curve = False
-    if len(remaining_swerveline) < 20:
-        remaining_swerveline.extend(swerveline)
-    if len(remaining_centerline) < 20:
-        remaining_swerveline.extend(centerline)
+    # distances and angle_between of the waypoints up to the first one 15m away, in one go
+    dists, angles = swerve_follower.lookahead(vehicle_state, 15) #10: #13
+    tight_curve = not tight_curve and abs(angles[0]) > (math.pi / 5)
     # steep curve coming up in near future
-    i = 0; a = 0
-    while distance2D(vehicle_state['pos'][:2], remaining_swerveline[i]) < 15: #10: #13
-        i += 1
-        a, a1 = angle_between(remaining_swerveline[i], vehicle_state)
-        if abs(a) > (math.pi / 4):
-            tight_curve = True
-            print("TIGHT CURVE!!!!!\nTIGHT CURVE!!!!!\nTIGHT CURVE!!!!!")
-            break
+    i = int(np.argmax(dists >= 15))
+    steep = np.nonzero(np.abs(angles[1:i + 1]) > (math.pi / 4))[0]
+    if len(steep):
+        i = int(steep[0]) + 1
+        tight_curve = True
+        print("TIGHT CURVE!!!!!\nTIGHT CURVE!!!!!\nTIGHT CURVE!!!!!")
     if tight_curve:
         throttle_setpoint = curve_kph_setpt
         steer_integral = 0; steer_prev_error = 0
     else:
-        i = 0
         throttle_setpoint = overall_kph_setpoint
-        while distance2D(vehicle_state['pos'][:2], remaining_swerveline[i]) < 7.5:
-            i += 1
+        i = int(np.argmax(dists >= 7.5))
         if i > 0:
             steer_integral = 0; steer_prev_error = 0
 
-    j = 0
-    while distance2D(vehicle_state['pos'][:2], remaining_centerline[j]) < 7.5:
-        j += 1
-
-    remaining_swerveline = remaining_swerveline[i:]
-    next_waypoint = remaining_swerveline[0]
-    remaining_centerline = remaining_centerline[j:]
+    swerve_follower.advance(i)
+    next_waypoint = swerve_follower.waypoint()
+    follower.advance(follower.first_beyond(vehicle_state['pos'], 7.5))
     inner_angle, innerangle1 = angle_between(next_waypoint, vehicle_state)
-    centerline_inner_angle, innerangle1 = angle_between(remaining_centerline[1], vehicle_state, remaining_centerline[0])
+    centerline_inner_angle, innerangle1 = angle_between(follower.waypoint(1), vehicle_state, follower.waypoint(0))
     # plt.figure(figsize=(8,8))
     # plt.scatter(next_centerline_point[0], next_centerline_point[1], marker="o", label="next_waypoint")
     # plt.scatter(vehicle_state['pos'][0], vehicle_state['pos'][1], marker="v", label="vehicle pos")
@@ -617,34 +549,22 @@ def plot_inputs(timestamps, inputs, title="Inputs by Time"):
     plt.show()
     plt.pause(0.01)
 
-def dist_from_line(centerline, point):
-    a = [[x[0],x[1]] for x in centerline[:-1]]
-    b = [[x[0],x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 # track is approximately 12.50m wide
 # car is approximately 1.85m wide
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    return min(distance_from_centerline) > 9.0
+    return distance_from_centerline > 9.0
 
 def turning_toward_centerline():
     #
     return
 
 def laps_completed(lapcount):
-    # remainder = centerline_interpolated.index(remaining_centerline[0])
-    t = np.array(centerline_interpolated) == np.array(remaining_centerline[0])
-    t = [np.all(tt) for tt in t]
-    remainder = t.index(True)
-    remainder = remainder / len(centerline_interpolated)
-    return lapcount + remainder
+    global follower
+    return lapcount + follower.lap_fraction()
 
 # kph setpoints, avg kph, # laps completed, just-recovery-behavior, swervingstdev, collectionscriptcommit
 def save_collection_metas(overall_kph_setpt, curve_kph_setpt, avg_kph, outcome, total_laps, just_recovery, swervingstdev): #, scriptcommit):
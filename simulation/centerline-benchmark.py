@@ -0,0 +1,55 @@
+import argparse
+import time
+
+import numpy as np
+
+from centerline import CenterlineIndex, lineseg_dists
+from trackgeometry import read_lap_file
+
+# usage: python centerline-benchmark.py [--centerline posefiles/DAVE2v1-lap-trajectory.txt] [--trajectories ...]
+# times calc_deviation_from_center on full-lap trajectories, no simulator needed
+
+
+def looped_deviation(centerline, traj):
+    # what calc_deviation_from_center did before CenterlineIndex: rebuild the segments and scan all of them per point
+    dists = []
+    for point in traj:
+        a = np.array([[x[0], x[1]] for x in centerline[:-1]])
+        b = np.array([[x[0], x[1]] for x in centerline[1:]])
+        dists.append(min(lineseg_dists([point[0], point[1]], a, b)))
+    return np.array(dists)
+
+
+def timeit(fxn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fxn()
+    return (time.perf_counter() - start) / repeats, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--centerline", type=str, default="posefiles/DAVE2v1-lap-trajectory.txt")
+    parser.add_argument("--trajectories", type=str, nargs="+",
+                        default=["posefiles/DAVE2v3-lap-trajectory.txt", "posefiles/DAVE2PytorchModel-lap-trajectory.txt"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    centerline = read_lap_file(args.centerline)
+    start = time.perf_counter()
+    index = CenterlineIndex(centerline)
+    print(f"centerline {args.centerline}: {len(centerline)} points, index built in {(time.perf_counter() - start) * 1000:.2f} ms")
+    for filename in args.trajectories:
+        traj = read_lap_file(filename)
+        t_looped, looped = timeit(lambda: looped_deviation(centerline, traj), 1)
+        t_points, points = timeit(lambda: np.array([index.distance(p) for p in traj]), args.repeats)
+        t_batch, batch = timeit(lambda: index.distances(traj), args.repeats)
+        err = max(np.abs(looped - points).max(), np.abs(looped - batch).max())
+        print(f"{filename}: {len(traj)} points, max abs diff {err:.2e}")
+        print(f"  per-point scan of every segment: {t_looped * 1000:9.2f} ms")
+        print(f"  per-point CenterlineIndex query: {t_points * 1000:9.2f} ms")
+        print(f"  CenterlineIndex.query_many:      {t_batch * 1000:9.2f} ms  ({t_looped / t_batch:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
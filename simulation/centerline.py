@@ -0,0 +1,156 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def lineseg_dists(p, a, b):
+    """Cartesian distance from point to line segment
+    Edited to support arguments as series, from:
+    https://stackoverflow.com/a/54442561/11208892
+    Args:
+        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
+        - a: np.array of shape (x, 2)
+        - b: np.array of shape (x, 2)
+    """
+    # zero-length segments give nan, like they always have; keep numpy quiet about it
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # normalized tangent vectors
+        d_ba = b - a
+        d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
+
+        # signed parallel distance components
+        # rowwise dot products of 2D vectors
+        s = np.multiply(a - p, d).sum(axis=1)
+        t = np.multiply(p - b, d).sum(axis=1)
+
+        # clamped parallel distance
+        h = np.maximum.reduce([s, t, np.zeros(len(s))])
+
+        # perpendicular distance component
+        # rowwise cross products of 2D vectors
+        d_pa = p - a
+        c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
+
+        return np.hypot(h, c)
+
+
+class CenterlineIndex():
+    """Nearest-segment queries against a polyline such as the interpolated centerline.
+
+    Built once per polyline: the segment endpoints, unit directions and
+    cumulative arc length are packed into numpy arrays, and a KD-tree over
+    the segment midpoints narrows every query down to the few segments
+    that can be nearest, so a query costs O(log n) instead of measuring
+    the distance to every segment. Only x and y are used. Segment i runs
+    from points[i] to points[i + 1]; offsets are positive to the left of
+    the direction of travel.
+    """
+
+    def __init__(self, points):
+        points = np.asarray([[p[0], p[1]] for p in points], dtype=float)
+        self.points = points
+        self.a, self.b = points[:-1], points[1:]
+        d_ba = self.b - self.a
+        self.lengths = np.hypot(d_ba[:, 0], d_ba[:, 1])
+        # zero-length segments (repeated points) can never be strictly nearest, so they are left out of the tree
+        self.valid = np.nonzero(self.lengths > 0)[0]
+        if len(self.valid) == 0:
+            raise ValueError("CenterlineIndex needs at least two distinct points")
+        self.directions = np.zeros_like(d_ba)
+        self.directions[self.valid] = d_ba[self.valid] / self.lengths[self.valid, None]
+        # arc length at the start of each point
+        self.arc_lengths = np.concatenate(([0.0], np.cumsum(self.lengths)))
+        self.tree = cKDTree((self.a[self.valid] + self.b[self.valid]) / 2)
+        self.max_half_length = self.lengths.max() / 2
+
+    def __len__(self):
+        return len(self.a)
+
+    def segment_distances(self, point):
+        # distance from point to every segment, what dist_from_line used to return
+        return lineseg_dists(np.asarray(point[:2], dtype=float), self.a, self.b)
+
+    def candidates(self, p):
+        # the nearest segment is at most as far as the segment of the nearest midpoint, so its own midpoint is
+        # within that distance plus half the longest segment
+        d0, _ = self.tree.query(p)
+        return np.sort(self.valid[self.tree.query_ball_point(p, d0 + self.max_half_length)])
+
+    def nearest(self, point):
+        # (index of the nearest segment, distance to it); ties go to the lowest index
+        p = np.asarray(point[:2], dtype=float)
+        idx = self.candidates(p)
+        dists = lineseg_dists(p, self.a[idx], self.b[idx])
+        k = int(np.argmin(dists))
+        return int(idx[k]), float(dists[k])
+
+    def distance(self, point):
+        return self.nearest(point)[1]
+
+    def query(self, point):
+        # (nearest segment, distance, signed lateral offset, arc length of the closest point on the polyline)
+        i, dist = self.nearest(point)
+        d_pa = np.asarray(point[:2], dtype=float) - self.a[i]
+        cross = self.directions[i, 0] * d_pa[1] - self.directions[i, 1] * d_pa[0]
+        along = min(max(float(np.dot(d_pa, self.directions[i])), 0.0), self.lengths[i])
+        return i, dist, dist if cross >= 0 else -dist, float(self.arc_lengths[i] + along)
+
+    def query_many(self, points, k=8, chunk_size=65536):
+        # query() for a (T, 2) or (T, 3) array of points at once: arrays of the nearest segments, distances, signed
+        # offsets and arc lengths. The k segments with the nearest midpoints are measured in one vectorized pass;
+        # points for which a segment outside those k could still be nearer fall back to nearest().
+        points = np.asarray([[p[0], p[1]] for p in points], dtype=float).reshape(-1, 2)
+        idx = np.empty(len(points), dtype=int)
+        dists = np.empty(len(points))
+        k = min(k, len(self.valid))
+        for start in range(0, len(points), chunk_size):
+            p = points[start:start + chunk_size]
+            mid_dists, mids = self.tree.query(p, k=k)
+            mid_dists, mids = mid_dists.reshape(len(p), k), mids.reshape(len(p), k)
+            # the k candidates of every point in one (T, k) array
+            cand = np.sort(self.valid[mids], axis=1)
+            a, d = self.a[cand], self.directions[cand]
+            d_pa = p[:, None] - a
+            along = (d_pa * d).sum(axis=2)
+            h = np.maximum.reduce([-along, along - self.lengths[cand], np.zeros_like(along)])
+            c = d_pa[..., 0] * d[..., 1] - d_pa[..., 1] * d[..., 0]
+            cand_dists = np.hypot(h, c)
+            best = np.argmin(cand_dists, axis=1)
+            rows = np.arange(len(p))
+            idx[start:start + len(p)] = cand[rows, best]
+            dists[start:start + len(p)] = cand_dists[rows, best]
+            # any other segment's midpoint is at least the k-th midpoint distance away
+            unsure = np.nonzero(dists[start:start + len(p)] > mid_dists[:, -1] - self.max_half_length)[0]
+            if k == len(self.valid):
+                unsure = unsure[:0]
+            for i in unsure:
+                idx[start + i], dists[start + i] = self.nearest(p[i])
+        d_pa = points - self.a[idx]
+        d = self.directions[idx]
+        cross = d[:, 0] * d_pa[:, 1] - d[:, 1] * d_pa[:, 0]
+        along = np.clip((d_pa * d).sum(axis=1), 0, self.lengths[idx])
+        return idx, dists, np.where(cross >= 0, dists, -dists), self.arc_lengths[idx] + along
+
+    def distances(self, points):
+        return self.query_many(points)[1]
+
+    def offset(self, point):
+        return self.query(point)[2]
+
+    def arc_length(self, point):
+        return self.query(point)[3]
+
+
+# recently used indexes, keyed by the polyline object they were built from
+_indexes = {}
+
+
+def centerline_index(points, max_entries=8):
+    # the CenterlineIndex for points, built on first use; rebuilt when the polyline's length changes
+    key = id(points)
+    entry = _indexes.get(key)
+    if entry is None or entry[0] is not points or entry[1] != len(points):
+        while len(_indexes) >= max_entries:
+            del _indexes[next(iter(_indexes))]
+        entry = (points, len(points), CenterlineIndex(points))
+        _indexes[key] = entry
+    return entry[2]
@@ -6,6 +6,8 @@ import sys
 # sys.path.append('H:/GitHub/BeamNGpy-meriels-ext/src')
 
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import read_lap_file
 from matplotlib import pyplot as plt
 import logging, random, string, time, copy, os
 
@@ -15,7 +17,6 @@ from beamngpy.sensors import Camera, GForces, Electrics, Damage, Timer
 
 import statistics, math
 from scipy.spatial.transform import Rotation as R
-from ast import literal_eval
 from scipy import interpolate
 
 from superdeepbillboard.deepbillboard import DeepBillboard, SuperDeepBillboard, GradientAscent
@@ -273,54 +274,15 @@ def write_results(training_file, results, all_trajs, unperturbed_traj,
         pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
 
 
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-    # signed parallel distance components
-    # rowwise dot products of 2D vectors
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-    # perpendicular distance component
-    # rowwise cross products of 2D vectors
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 
 # return distance between two 3d points
 def distance(a, b):
     return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
 
 
-def dist_from_line(centerline, point):
-    a = [[x[0], x[1]] for x in centerline[:-1]]
-    b = [[x[0], x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 
 def calc_deviation_from_center(centerline, traj):
-    dists = []
-    for point in traj:
-        dist = dist_from_line(centerline, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(centerline).distances(traj))
     avg_dist = sum(dists) / len(dists)
     stddev = statistics.stdev(dists)
     return stddev, dists, avg_dist
@@ -328,13 +290,7 @@ def calc_deviation_from_center(centerline, traj):
 
 def intake_lap_file(filename="DAVE2v1-lap-trajectory.txt"):
     global expected_trajectory
-    expected_trajectory = []
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.replace("\n", "")
-            line = literal_eval(line)
-            expected_trajectory.append(line)
+    expected_trajectory = read_lap_file(filename)
 
 
 def road_analysis(bng):
@@ -384,17 +340,14 @@ def create_ai_line_from_road_with_interpolation():
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    return min(distance_from_centerline) > 10
+    return distance_from_centerline > 10
 
 
 def returned_to_expected_traj(pos_window):
     global expected_trajectory
-    dists = []
-    for point in pos_window:
-        dist = dist_from_line(expected_trajectory, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(expected_trajectory).distances(pos_window))
     avg_dist = sum(dists) / len(dists)
     if avg_dist < 1:
         return True
@@ -1,6 +1,9 @@
 import random, math
 import sys, time
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import TrackGeometry
+from waypoints import WaypointFollower
 import os, copy
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import imshow
@@ -29,7 +32,7 @@ swervingstdev = None
 throttle_setpoint = overall_throttle_setpoint
 integral=0; prev_error=0
 steer_integral=0; steer_prev_error=0; steer_prev_setpoint = 0
-remaining_centerline = []
+follower = None
 centerline = []
 centerline_interpolated = []
 roadleft = []
@@ -223,34 +226,6 @@ def setup_dir(training_dir):
         os.mkdir(training_dir)
     return "{}/data.csv".format(training_dir)
 
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-    # signed parallel distance components
-    # rowwise dot products of 2D vectors
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-    # perpendicular distance component
-    # rowwise cross products of 2D vectors
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 def turn_90(rot_quat):
     r = R.from_quat(list(rot_quat))
     r = r.as_euler('xyz', degrees=True)
@@ -473,15 +448,14 @@ def intake_ai_lap_poses(filename="ai_lap_data.txt"):
 def get_start_index(adjusted_middle):
     global default_scenario, spawnpoint
     sp = spawn_point(default_scenario, spawnpoint)
-    distance_from_centerline = dist_from_line(adjusted_middle, sp['pos'])
-    # idx = adjusted_middle.index(min(distance_from_centerline))
-    idx = max(np.where(distance_from_centerline == min(distance_from_centerline)))
-    return idx[0]
+    idx, _ = centerline_index(adjusted_middle).nearest(sp['pos'])
+    return idx
     
 def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
-    global centerline, remaining_centerline, centerline_interpolated
+    global centerline, follower, centerline_interpolated
     points = []; point_colors = []; spheres = []; sphere_colors = []; traj = []
-    actual_middle, adjusted_middle = road_analysis(bng)
+    track = TrackGeometry(default_scenario, spawnpoint, None, bng)
+    actual_middle, adjusted_middle = road_analysis(track)
     print("finished road analysis")
     start_index = get_start_index(adjusted_middle)
     middle_end = adjusted_middle[:start_index]
@@ -550,16 +524,7 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
             sphere_colors.append([1, 0, 0, 0.8])
             # count += 1
     else: # not swerving
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                traj.extend([[x,y,p[2]] for x,y in zip(xs,ys)])
-            else:
-                traj.append(copy.deepcopy(p))
+        traj = track.centerline(middle).tolist()
     print("set up debug line")
     # set up debug line
     for i,p in enumerate(actual_middle[:-1]):
@@ -571,7 +536,9 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
     print("beginning of script:{}".format(middle[0]))
     plot_trajectory(traj, "Points on Script (Final)", "AI debug line")
     centerline = copy.deepcopy(traj)
-    remaining_centerline = copy.deepcopy(traj)
+    # the compiled centerline comes with its headings, the swerving line gets them computed here
+    follower = WaypointFollower(traj) if swerving else track.follower(middle)
+    track.save()
     centerline_interpolated = copy.deepcopy(traj)
     # for i in range(4):
     #     centerline.extend(copy.deepcopy(centerline))
@@ -611,38 +578,30 @@ def angle_between(next_waypoint, vehicle_state):
     return math.atan2(math.sin(inner_angle), math.cos(inner_angle))
 
 def steering_setpoint(vehicle_state, traj=None):
-    global remaining_centerline, centerline, throttle_setpoint, overall_throttle_setpoint
+    global follower, centerline, throttle_setpoint, overall_throttle_setpoint
     global steer_integral, steer_prev_error, steer_prev_setpoint
     global tight_curve, avg_error
-    if len(remaining_centerline) < 20:
-        remaining_centerline.append(centerline_interpolated)
     # update next waypoint if you've reached your current one
     # normal driving circumstances
-    # is there an upcoming tight curve?
-    # shallow curve coming up soon
-    if (angle_between(remaining_centerline[5], vehicle_state) > (math.pi / 6) or
-        angle_between(remaining_centerline[9], vehicle_state) < -(math.pi / 8)): #6.55):
-        slowdown = True
+    # the angles to the waypoints up to the first one 20m away only matter when one of them can pass its threshold:
+    # bound them from the track headings first and skip computing them on the straights
+    i = follower.first_beyond(vehicle_state['pos'], 20)
+    lo, hi = follower.angle_bounds(vehicle_state, 1, max(i, 9) + 1)
+    if lo >= -(math.pi / 8) and hi <= (math.pi / 6):
+        slowdown = tight_curve = False
+        steep = []
     else:
-        slowdown = False
-    if not tight_curve and (angle_between(remaining_centerline[3], vehicle_state) > (math.pi / 3.25) or
-        angle_between(remaining_centerline[8], vehicle_state) < -(math.pi / 6.75)): #6.55):
-        # print(abs(angle_between(remaining_centerline[0], vehicle_state)), "> (math.pi / 6)")
+        angles = follower.angles(vehicle_state, 0, max(i + 1, 10)) #15: #10: #13
+        # shallow curve coming up soon
+        slowdown = angles[5] > (math.pi / 6) or angles[9] < -(math.pi / 8) #6.55)
+        # is there an upcoming tight curve?
+        tight_curve = not tight_curve and (angles[3] > (math.pi / 3.25) or angles[8] < -(math.pi / 6.75)) #6.55)
+        # steep curve coming up in near future
+        steep = np.nonzero(np.abs(angles[1:i + 1]) > (math.pi / 3.5))[0]
+    if len(steep):
+        i = int(steep[0]) + 1
         tight_curve = True
-    else:
-        tight_curve = False
-
-    # steep curve coming up in near future
-    i = 0; a = 0
-    while distance2D(vehicle_state['pos'][:2], remaining_centerline[i]) < 20: #15: #10: #13
-        i += 1
-        a = angle_between(remaining_centerline[i], vehicle_state)
-        if abs(a) > (math.pi / 3.5):
-            # print(abs(a), "> math.pi/4")
-            tight_curve = True
-            print("TIGHT CURVE!!!!!\nTIGHT CURVE!!!!!\nTIGHT CURVE!!!!!")
-            break
-    # print("lookahead angle:", a)
+        print("TIGHT CURVE!!!!!\nTIGHT CURVE!!!!!\nTIGHT CURVE!!!!!")
     changed = False
     if tight_curve or slowdown:
         throttle_setpoint = 32.5
@@ -650,15 +609,12 @@ def steering_setpoint(vehicle_state, traj=None):
     else:
         if throttle_setpoint == 32.5:
             steer_integral = 0; steer_prev_error = 0
-        i = 0
         throttle_setpoint = overall_throttle_setpoint
-        while distance2D(vehicle_state['pos'][:2], remaining_centerline[i]) < 7.5:
-            i += 1
-            # changed = True
+        i = follower.first_beyond(vehicle_state['pos'], 7.5)
         if i > 0:
             steer_integral = 0; steer_prev_error = 0
-    remaining_centerline = remaining_centerline[i:]
-    next_waypoint = remaining_centerline[0]
+    follower.advance(i)
+    next_waypoint = follower.waypoint()
     inner_angle = angle_between(next_waypoint, vehicle_state)
     # print("distance to next waypoint:",distance2D(vehicle_state['pos'][:2], next_waypoint[:2]))
     # plt.figure(figsize=(8,8))
@@ -679,29 +635,19 @@ def plot_inputs(timestamps, inputs, title="Inputs by Time"):
     plt.show()
     plt.pause(0.01)
 
-def dist_from_line(centerline, point):
-    a = [[x[0],x[1]] for x in centerline[:-1]]
-    b = [[x[0],x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 # track is approximately 12.50m wide
 # car is approximately 1.85m wide
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    # print("Distance from center of road:", min(distance_from_centerline))
-    return min(distance_from_centerline) > 15.0
+    # print("Distance from center of road:", distance_from_centerline)
+    return distance_from_centerline > 15.0
 
 def laps_completed(lapcount):
-    global centerline_interpolated, remaining_centerline
-    remainder = centerline_interpolated.index(remaining_centerline[0])
-    remainder = remainder / len(centerline_interpolated)
-    return lapcount + remainder
+    global follower
+    return lapcount + follower.lap_fraction()
 
 # kph setpoints, avg kph, # laps completed, just-recovery-behavior, swervingstdev, collectionscriptcommit
 def save_collection_metas(overall_kph_setpt, curve_kph_setpt, avg_kph, outcome, total_laps, just_recovery, swervingstdev): #, scriptcommit):
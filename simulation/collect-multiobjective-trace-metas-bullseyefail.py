@@ -7,6 +7,8 @@ print(args)
 
 import warnings
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import TrackGeometry, read_lap_file
 from matplotlib import pyplot as plt
 import logging, random, string, time, copy, os, sys, shutil
 
@@ -22,9 +24,8 @@ from beamngpy.sensors import Camera, GForces, Electrics, Damage, Timer
 
 import statistics, math
 from scipy.spatial.transform import Rotation as R
-from ast import literal_eval
 from scipy import interpolate
-from deepbillboard import SuperDeepBillboard
+from deepbillboard import SuperDeepBillboard, PredictionCache, DeviceResidency
 
 import torch
 import cv2
@@ -338,65 +339,19 @@ def write_results(training_file, results, all_trajs, unperturbed_traj,
     with open(training_file, "wb") as f:
         pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
 
-@ignore_warnings
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-    # signed parallel distance components
-    # rowwise dot products of 2D vectors
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-    # perpendicular distance component
-    # rowwise cross products of 2D vectors
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 # return distance between two 3d points
 def distance(a, b):
     return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
 
-def dist_from_line(centerline, point):
-    a = [[x[0], x[1]] for x in centerline[:-1]]
-    b = [[x[0], x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 def calc_deviation_from_center(centerline, traj):
-    dists = []
-    for point in traj:
-        dist = dist_from_line(centerline, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(centerline).distances(traj))
     avg_dist = sum(dists) / len(dists)
     stddev = statistics.stdev(dists)
     return stddev, dists, avg_dist
 
 def intake_lap_file(filename="posefiles/DAVE2v1-lap-trajectory.txt"):
     global expected_trajectory
-    expected_trajectory = []
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.replace("\n", "")
-            line = literal_eval(line)
-            expected_trajectory.append(line)
+    expected_trajectory = read_lap_file(filename)
 
 def road_analysis(bng):
     global centerline, roadleft, roadright, roadmiddle
@@ -482,14 +437,14 @@ def plot_trajectory(traj, title="Trajectory", label1="AI behavior"):
 def get_start_index(adjusted_middle):
     global default_scenario, default_spawnpoint
     sp = spawn_point(default_scenario, default_spawnpoint)
-    distance_from_centerline = dist_from_line(adjusted_middle, sp['pos'])
-    idx = max(np.where(distance_from_centerline == min(distance_from_centerline)))
-    return idx[0]
+    idx, _ = centerline_index(adjusted_middle).nearest(sp['pos'])
+    return idx
 
 def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
     global centerline, remaining_centerline, centerline_interpolated, roadleft, roadright
     points = []; point_colors = []; spheres = []; sphere_colors = []; traj = []
-    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(bng)
+    track = TrackGeometry(default_scenario, default_spawnpoint, args.road_id, bng)
+    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(track)
     print("finished road analysis")
     start_index = get_start_index(adjusted_middle)
     middle_end = adjusted_middle[:start_index]
@@ -558,16 +513,8 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
             sphere_colors.append([1, 0, 0, 0.8])
             # count += 1
     else: # not swerving
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                traj.extend([[x,y,p[2]] for x,y in zip(xs,ys)])
-            else:
-                traj.append(copy.deepcopy(p))
+        traj = track.centerline(middle).tolist()
+    track.save()
     print("set up debug line")
     # set up debug line
     for i,p in enumerate(adjusted_middle[:-1]):
@@ -614,16 +561,16 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    return min(distance_from_centerline) > 9.0 #10,9.5,9.25
+    return distance_from_centerline > 9.0 #10,9.5,9.25
 
 def has_car_almost_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    mindist = min(distance_from_centerline)
+    mindist = distance_from_centerline
     print(f"dist from centerline={mindist}")
     return mindist > 1.5
 
@@ -648,8 +595,7 @@ def calc_points_of_reachable_set(vehicle_state):
 def nearest_seg(road, pos):
     global roadleft, roadright
     road_seg = {}
-    dists = dist_from_line(road, pos)
-    idx = max(np.where(dists == min(dists)))[0]
+    idx, _ = centerline_index(road).nearest(pos)
     road_seg_left, road_seg_right = [], []
     # road_seg_center = []
     for i in range(-1,15):
@@ -801,10 +747,7 @@ def plot_facing_bb_with_CV2(vehicle_state, rs, road_seg, intersection, bbox, cur
 
 def returned_to_expected_traj(pos_window):
     global expected_trajectory
-    dists = []
-    for point in pos_window:
-        dist = dist_from_line(expected_trajectory, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(expected_trajectory).distances(pos_window))
     avg_dist = sum(dists) / len(dists)
     return avg_dist < 1
 
@@ -1059,9 +1002,16 @@ def get_percent_of_image(coords, img):
     return patch_size / img_size
 
 def superdeepbillboard(model, sequence, direction, steering_vector, bb_size=5, iterations=400, noise_level=25,
-                       dist_to_bb=None, last_billboard=None, loss_fxn="MDirE", facing_target=None, input_div=False):
+                       dist_to_bb=None, last_billboard=None, loss_fxn="MDirE", facing_target=None, input_div=False,
+                       sdbb=None, refine_iterations=25, predictions=None, residency=None):
                        # facing_target={"facing":False, "max":0,"min":0}):
-    sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction)
+    # pass the same sdbb instance at every step to warm-start from the previous perturbation
+    # predictions: PredictionCache shared with the caller, so clean frames only go through the model once
+    # residency: DeviceResidency shared with the caller, which keeps the model on its device for the whole run
+    warm_start = sdbb is not None
+    if sdbb is None:
+        sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction, predictions=predictions,
+                                                     residency=residency)
     img_arr = [hashmap['image'] for hashmap in sequence]
     img_patches = [hashmap['bbox'][0] for hashmap in sequence]
     new_img_patches = []
@@ -1094,18 +1044,21 @@ def superdeepbillboard(model, sequence, direction, steering_vector, bb_size=5, i
     bb, y, MAE = sdbb.perturb_images(img_arr, np.array(new_img_patches), model,
                                                         tensorized_steering_vector, bb_size=bb_size,
                                                         iterations=iterations, noise_level=noise_level,
-                                                        last_billboard=last_billboard, loss_fxn=loss_fxn, input_divers=input_div)
+                                                        last_billboard=last_billboard, loss_fxn=loss_fxn, input_divers=input_div,
+                                                        warm_start=warm_start, refine_iterations=refine_iterations)
     return bb, y, MAE
 
 def run_scenario_superdeepbillboard_target(vehicle, bng, model, spawn, direction, dist_to_bb_cuton=26, dist_to_bb_cutoff=0, run_number=0,
                                     collect_sequence_results=None,
-                                    bb_size=5, iterations=400, noise_level=25, resultsdir="images", lossfxn="MDirE", input_div=False):
+                                    bb_size=5, iterations=400, noise_level=25, resultsdir="images", lossfxn="MDirE", input_div=False,
+                                    incremental=False, refine_iterations=25):
     global default_spawnpoint, unperturbed_traj, unperturbed_steer
     starttime = time.time()
     pert_billboards, perturbation_run_results = run_scenario_for_superdeepbillboard_target(vehicle, bng, model, spawn, direction,
                                                                                bb_size=bb_size, iterations=iterations, noise_level=noise_level,
                                                                                 dist_to_bb_cuton=dist_to_bb_cuton, dist_to_bb_cutoff=dist_to_bb_cutoff,
-                                                                                lossfxn=lossfxn, input_div=input_div)
+                                                                                lossfxn=lossfxn, input_div=input_div,
+                                                                                incremental=incremental, refine_iterations=refine_iterations)
     timetorun = time.time() - starttime
     print("Time to perturb:", timetorun)
     plt.title("sdbb final pert_billboard")
@@ -1129,6 +1082,8 @@ def run_scenario_superdeepbillboard_target(vehicle, bng, model, spawn, direction
     results['pertrun_dist'] = perturbation_run_results['avg_dist']
     results["num_billboards"] = perturbation_run_results["num_billboards"]
     results["MAE_collection_sequence"] = perturbation_run_results["MAE"]
+    results["incremental"] = incremental
+    results["refine_iterations"] = refine_iterations if incremental else None
     for i in range(10):
         # runresults = run_scenario_with_perturbed_billboard(vehicle, bng, model, spawn, pert_billboards[-1],
         #                                                    run_number=i)
@@ -1598,11 +1553,14 @@ def car_facing_billboard(vehicle_state, vehicle_bbox):
 
 def run_scenario_for_superdeepbillboard_target(vehicle, bng, model, spawn, direction, dist_to_bb_cuton=26, dist_to_bb_cutoff=26,
                                         bb_size=5, iterations=100, noise_level=25,
-                                        device=torch.device('cuda'), lossfxn="MDirE", input_div=False):
+                                        device=torch.device('cuda'), lossfxn="MDirE", input_div=False,
+                                        incremental=False, refine_iterations=25):
     global new_results_dir, centerline, expected_trajectory, qr_positions, setpoint
     reset_pid()
     runtime = 0.0
-    model = model.to(device)
+    # the model stays on the device for the whole run, the engines no longer move it to the CPU
+    residency = DeviceResidency.DeviceResidency(device)
+    model = residency.pin(model)
     bng.restart_scenario()
     vehicle.update_vehicle()
     sensors = bng.poll_sensors(vehicle)
@@ -1617,6 +1575,11 @@ def run_scenario_for_superdeepbillboard_target(vehicle, bng, model, spawn, direc
     start_time = sensors['timer']['time']
     final_img, outcome = None, None
     bb_viewed_window = np.ones((10))
+    # incremental mode keeps one engine for the whole run and refines its last perturbation at each step
+    # unperturbed predictions of the collected frames, computed once per frame and shared with the engines
+    clean_predictions = PredictionCache.PredictionCache(model, device=device)
+    sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction, predictions=clean_predictions,
+                                                 residency=residency) if incremental else None
     qrbox_pos = list(qr_positions[0][0])  # bng.scenario._get_objects_list()[-1]['options']['position'][:2] #
     while damage <= 0:
         # collect images
@@ -1682,9 +1645,9 @@ def run_scenario_for_superdeepbillboard_target(vehicle, bng, model, spawn, direc
             pert_billboard, y, MAE = superdeepbillboard(model, sequence, direction, copy.deepcopy(steering_vector),
                                                    bb_size=bb_size, iterations=iterations, noise_level=noise_level,
                                                    dist_to_bb=dist_to_bb, loss_fxn=lossfxn, facing_target=facing_target,
-                                                   input_div=input_div)
+                                                   input_div=input_div, sdbb=sdbb, refine_iterations=refine_iterations,
+                                                   predictions=clean_predictions, residency=residency)
             steering_vector.append(last_steering_from_sim)
-            model = model.to(device)
             ys = y
             pert_billboards.append(copy.deepcopy(pert_billboard))
             image = add_perturbed_billboard(origimage, pert_billboard, qr_corners[0])
@@ -1711,8 +1674,8 @@ def run_scenario_for_superdeepbillboard_target(vehicle, bng, model, spawn, direc
         all_ys.append(steering)
 
         if bbox_img is not None and kph > 29 and round(dist_to_bb,0) <= dist_to_bb_cuton:
-            origimg = model.process_image(np.asarray(origimage)).to(device)
-            unperturbed_predictions.append(float(model(origimg).cpu()[0][0]))
+            clean_prediction = clean_predictions.sync([hashmap['image'] for hashmap in sequence])[-1]
+            unperturbed_predictions.append(float(clean_prediction.cpu()[0]))
             perturbed_predictions.append(steering)
             angleerror_runtimes.append(runtime)
             traj.append(vehicle.state['front'])
@@ -1756,6 +1719,9 @@ def main():
     cutons = [24, 28]
     lossfxns = ["MSE"]
     input_divs = [False]
+    # True warm-starts each step from the previous perturbation and only refines it for refine_its iterations
+    incremental = False
+    refine_its = 25
     steps_per_sec = 15
     samples = 5
     vehicle, bng, model, spawn = setup_beamng(setup_args, vehicle_model='hopper', model_name=model_name)
@@ -1764,7 +1730,9 @@ def main():
         os.mkdir("results/{}".format(newdir))
         print(f"Copying script to {os.getcwd()}/{__file__}")
         shutil.copy(f"{os.getcwd()}/{__file__}", f"results/{newdir}")
-        shutil.copy(f"{os.getcwd()}/../deepbillboard/SuperDeepBillboard.py", f"results/{newdir}")
+        # the whole package: SuperDeepBillboard is a thin wrapper around PerturbationEngine and its strategy modules
+        shutil.copytree(f"{os.getcwd()}/../deepbillboard", f"results/{newdir}/deepbillboard",
+                        ignore=shutil.ignore_patterns("__pycache__"))
 
     intake_lap_file(f"posefiles/DAVE2v3-lap-trajectory.txt")
     # actual_middle, adjusted_middle, roadleft, roadright = road_analysis(bng)
@@ -1789,7 +1757,8 @@ def main():
 
                                     results = run_scenario_superdeepbillboard_target(vehicle, bng, model, spawn, direction, collect_sequence_results=unperturbed_results,
                                                                               bb_size=bbsize, iterations=its, noise_level=nl, dist_to_bb_cuton=cuton,
-                                                                              dist_to_bb_cutoff=rsc, resultsdir=new_results_dir, lossfxn=lossfxn, input_div=input_div)
+                                                                              dist_to_bb_cutoff=rsc, resultsdir=new_results_dir, lossfxn=lossfxn, input_div=input_div,
+                                                                              incremental=incremental, refine_iterations=refine_its)
                                     all_trajs.append(results["pertrun_traj"])
                                     all_outcomes.append(results["pertrun_outcome"])
                                     plot_errors(results['testruns_error'], training_file.replace(".pickle", ".png"))
@@ -8,6 +8,8 @@ print(args)
 
 import warnings
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import TrackGeometry, read_lap_file
 from matplotlib import pyplot as plt
 import logging, random, string, time, copy, os, sys, shutil
 
@@ -24,7 +26,6 @@ from beamngpy.sensors import Camera, GForces, Electrics, Damage, Timer
 
 import statistics, math
 from scipy.spatial.transform import Rotation as R
-from ast import literal_eval
 from scipy import interpolate
 import torch
 import cv2
@@ -359,60 +360,19 @@ def write_results(training_file, results, all_trajs, unperturbed_traj,
         pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
 
 
-@ignore_warnings
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-    # signed parallel distance components (rowwise dot products of 2D vectors)
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-    # perpendicular distance component (rowwise cross products of 2D vectors)
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 # return distance between two 3d points
 def distance(a, b):
     return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
 
-def dist_from_line(centerline, point):
-    a = [[x[0], x[1]] for x in centerline[:-1]]
-    b = [[x[0], x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 def calc_deviation_from_center(centerline, traj):
-    dists = []
-    for point in traj:
-        dist = dist_from_line(centerline, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(centerline).distances(traj))
     avg_dist = sum(dists) / len(dists)
     stddev = statistics.stdev(dists)
     return stddev, dists, avg_dist
 
 def intake_lap_file(filename="posefiles/DAVE2v3-lap-trajectory.txt"):
     global expected_trajectory
-    expected_trajectory = []
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.replace("\n", "")
-            line = literal_eval(line)
-            expected_trajectory.append(line)
+    expected_trajectory = read_lap_file(filename)
 
 def plot_racetrack_roads(roads, bng):
     global default_scenario, default_spawnpoint
@@ -539,15 +499,15 @@ def plot_trajectory(traj, title="Trajectory", label1="AI behavior"):
 def get_start_index(adjusted_middle):
     global default_scenario, default_spawnpoint
     sp = spawn_point(default_scenario, default_spawnpoint)
-    distance_from_centerline = dist_from_line(adjusted_middle, sp['pos'])
-    idx = max(np.where(distance_from_centerline == min(distance_from_centerline)))
-    return idx[0]
+    idx, _ = centerline_index(adjusted_middle).nearest(sp['pos'])
+    return idx
 
 
 def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
     global centerline, remaining_centerline, centerline_interpolated, roadleft, roadright
     points = []; point_colors = []; spheres = []; sphere_colors = []; traj = []
-    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(bng)
+    track = TrackGeometry(default_scenario, default_spawnpoint, args.road_id, bng)
+    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(track)
     print("finished road analysis")
     start_index = get_start_index(adjusted_middle)
     middle_end = adjusted_middle[:start_index]
@@ -616,16 +576,8 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
             sphere_colors.append([1, 0, 0, 0.8])
             # count += 1
     else: # not swerving
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                traj.extend([[x,y,p[2]] for x,y in zip(xs,ys)])
-            else:
-                traj.append(copy.deepcopy(p))
+        traj = track.centerline(middle).tolist()
+    track.save()
     print("set up debug line")
     # set up debug line
     for i,p in enumerate(adjusted_middle[:-1]):
@@ -672,16 +624,16 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    return min(distance_from_centerline) > 9.0 #10,9.5,9.25
+    return distance_from_centerline > 9.0 #10,9.5,9.25
 
 def has_car_almost_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    mindist = min(distance_from_centerline)
+    mindist = distance_from_centerline
     return mindist > 1.5
 
 def calc_points_of_reachable_set(vehicle_state):
@@ -710,8 +662,7 @@ def calc_yaw(vehicle_state, vehicle_bbox):
 def nearest_seg(road, pos):
     global roadleft, roadright
     road_seg = {}
-    dists = dist_from_line(road, pos)
-    idx = max(np.where(dists == min(dists)))[0]
+    idx, _ = centerline_index(road).nearest(pos)
     road_seg_left = []
     road_seg_right = []
     # road_seg_center = []
@@ -813,10 +764,7 @@ def plot_intersection(vehicle_state, rs, road_seg, intersection, bbox):
 
 def returned_to_expected_traj(pos_window):
     global expected_trajectory
-    dists = []
-    for point in pos_window:
-        dist = dist_from_line(expected_trajectory, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(expected_trajectory).distances(pos_window))
     avg_dist = sum(dists) / len(dists)
     return round(avg_dist, 0) < 1
 
@@ -1722,7 +1670,9 @@ def main():
         os.mkdir("results/{}".format(newdir))
         print(f"Copying script to {os.getcwd()}/{__file__}")
         shutil.copy(f"{os.getcwd()}/{__file__}", f"results/{newdir}")
-        shutil.copy(f"{os.getcwd()}/../deepbillboard/SuperDeepBillboard.py", f"results/{newdir}")
+        # the whole package: SuperDeepBillboard is a thin wrapper around PerturbationEngine and its strategy modules
+        shutil.copytree(f"{os.getcwd()}/../deepbillboard", f"results/{newdir}/deepbillboard",
+                        ignore=shutil.ignore_patterns("__pycache__"))
     intake_lap_file(f"posefiles/DAVE2v3-lap-trajectory.txt")
     bng = create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False)
 
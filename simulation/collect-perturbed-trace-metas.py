@@ -8,6 +8,8 @@ print(args)
 
 import warnings
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import TrackGeometry, read_lap_file
 from matplotlib import pyplot as plt
 import logging, random, string, time, copy, os, sys, shutil
 
@@ -17,14 +19,13 @@ sys.path.append(f'{args.path2src}/GitHub/BeamNGpy')
 sys.path.append(f'{args.path2src}/GitHub/BeamNGpy/src/')
 print(sys.path)
 
-from deepbillboard import DeepBillboard, SuperDeepBillboard
+from deepbillboard import DeepBillboard, SuperDeepBillboard, StoppingCriteria, PredictionCache, DeviceResidency
 from beamngpy import BeamNGpy, Scenario, Vehicle, setup_logging, StaticObject, ScenarioObject
 from beamngpy import ProceduralCube #,ProceduralCylinder, ProceduralCone, ProceduralBump, ProceduralRing
 from beamngpy.sensors import Camera, GForces, Electrics, Damage, Timer
 
 import statistics, math
 from scipy.spatial.transform import Rotation as R
-from ast import literal_eval
 from scipy import interpolate
 import torch
 import cv2
@@ -344,60 +345,19 @@ def write_results(training_file, results, all_trajs, unperturbed_traj,
         pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
 
 
-@ignore_warnings
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-    # signed parallel distance components (rowwise dot products of 2D vectors)
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-    # perpendicular distance component (rowwise cross products of 2D vectors)
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 # return distance between two 3d points
 def distance(a, b):
     return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
 
-def dist_from_line(centerline, point):
-    a = [[x[0], x[1]] for x in centerline[:-1]]
-    b = [[x[0], x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 def calc_deviation_from_center(centerline, traj):
-    dists = []
-    for point in traj:
-        dist = dist_from_line(centerline, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(centerline).distances(traj))
     avg_dist = sum(dists) / len(dists)
     stddev = statistics.stdev(dists)
     return stddev, dists, avg_dist
 
 def intake_lap_file(filename="posefiles/DAVE2v3-lap-trajectory.txt"):
     global expected_trajectory
-    expected_trajectory = []
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.replace("\n", "")
-            line = literal_eval(line)
-            expected_trajectory.append(line)
+    expected_trajectory = read_lap_file(filename)
 
 def plot_racetrack_roads(roads, bng):
     global default_scenario, default_spawnpoint
@@ -523,15 +483,15 @@ def plot_trajectory(traj, title="Trajectory", label1="AI behavior"):
 def get_start_index(adjusted_middle):
     global default_scenario, default_spawnpoint
     sp = spawn_point(default_scenario, default_spawnpoint)
-    distance_from_centerline = dist_from_line(adjusted_middle, sp['pos'])
-    idx = max(np.where(distance_from_centerline == min(distance_from_centerline)))
-    return idx[0]
+    idx, _ = centerline_index(adjusted_middle).nearest(sp['pos'])
+    return idx
 
 
 def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
     global centerline, remaining_centerline, centerline_interpolated, roadleft, roadright
     points = []; point_colors = []; spheres = []; sphere_colors = []; traj = []
-    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(bng)
+    track = TrackGeometry(default_scenario, default_spawnpoint, args.road_id, bng)
+    actual_middle, adjusted_middle, roadleft, roadright = road_analysis(track)
     print("finished road analysis")
     start_index = get_start_index(adjusted_middle)
     middle_end = adjusted_middle[:start_index]
@@ -600,16 +560,8 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
             sphere_colors.append([1, 0, 0, 0.8])
             # count += 1
     else: # not swerving
-        for i,p in enumerate(middle[:-1]):
-            # interpolate at 1m distance
-            if distance(p, middle[i+1]) > 1:
-                y_interp = interpolate.interp1d([p[0], middle[i + 1][0]], [p[1], middle[i + 1][1]])
-                num = int(distance(p, middle[i + 1]))
-                xs = np.linspace(p[0], middle[i + 1][0], num=num, endpoint=True)
-                ys = y_interp(xs)
-                traj.extend([[x,y,p[2]] for x,y in zip(xs,ys)])
-            else:
-                traj.append(copy.deepcopy(p))
+        traj = track.centerline(middle).tolist()
+    track.save()
     print("set up debug line")
     # set up debug line
     for i,p in enumerate(adjusted_middle[:-1]):
@@ -656,16 +608,16 @@ def create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False):
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    return min(distance_from_centerline) > 9.0 #10,9.5,9.25
+    return distance_from_centerline > 9.0 #10,9.5,9.25
 
 def has_car_almost_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
     # check if it went over left edge
-    mindist = min(distance_from_centerline)
+    mindist = distance_from_centerline
     return mindist > 1.5
 
 def calc_points_of_reachable_set(vehicle_state):
@@ -694,8 +646,7 @@ def calc_yaw(vehicle_state, vehicle_bbox):
 def nearest_seg(road, pos):
     global roadleft, roadright
     road_seg = {}
-    dists = dist_from_line(road, pos)
-    idx = max(np.where(dists == min(dists)))[0]
+    idx, _ = centerline_index(road).nearest(pos)
     road_seg_left = []
     road_seg_right = []
     # road_seg_center = []
@@ -797,10 +748,7 @@ def plot_intersection(vehicle_state, rs, road_seg, intersection, bbox):
 
 def returned_to_expected_traj(pos_window):
     global expected_trajectory
-    dists = []
-    for point in pos_window:
-        dist = dist_from_line(expected_trajectory, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(expected_trajectory).distances(pos_window))
     avg_dist = sum(dists) / len(dists)
     return round(avg_dist, 0) < 1
 
@@ -1036,7 +984,8 @@ def add_perturbed_billboard(img, bb, qr_corners):
     img = overlay_transparent(np.array(img), bb, np.asarray(qr_corners))
     return img
 
-def deepbillboard(model, sequence, direction, bb_size=5, iterations=400, noise_level=25, input_divers=False):
+def deepbillboard(model, sequence, direction, bb_size=5, iterations=400, noise_level=25, input_divers=False,
+                  stopping=None, step_log=None, seed=None):
     deepbb = DeepBillboard.DeepBillboard(model, sequence, direction)
     img_arr = [hashmap['image'] for hashmap in sequence]
     img_patches = [hashmap['bbox'][0] for hashmap in sequence]
@@ -1048,7 +997,10 @@ def deepbillboard(model, sequence, direction, bb_size=5, iterations=400, noise_l
             temp.append(tup[1])
         new_img_patches.append(copy.deepcopy(temp))
     perturbed_billboard_images = deepbb.perturb_images(img_arr, np.array(new_img_patches), model, bb_size=bb_size, iterations=iterations,
-                                                       noise_level=noise_level, input_divers=input_divers)
+                                                       noise_level=noise_level, input_divers=input_divers, stopping=stopping,
+                                                       seed=seed)
+    if step_log is not None:
+        step_log.append(dict(deepbb.stats))
     return perturbed_billboard_images
 
 def get_percent_of_image(coords, img):
@@ -1060,8 +1012,21 @@ def get_percent_of_image(coords, img):
 
 
 def superdeepbillboard(model, sequence, direction, steering_vector, bb_size=5, iterations=400, noise_level=25,
-                       dist_to_bb=None, last_billboard=None, input_divers=True, loss_fxn='inv23'):
-    sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction)
+                       dist_to_bb=None, last_billboard=None, input_divers=True, loss_fxn='inv23', sdbb=None, refine_iterations=25,
+                       population=None, time_budget=None, stopping=None, step_log=None, seed=None, predictions=None,
+                       residency=None):
+    # pass the same sdbb instance at every step to warm-start from the previous perturbation
+    # population: dict of seeds/noise_levels/step_sizes to optimize as one batch of candidates, see perturb_population
+    # time_budget: wall-clock seconds per call, the best perturbation so far is used when it runs out
+    # stopping: list of StoppingCriteria that end each call early
+    # each call's sdbb.stats (and candidate loss curves) are appended to step_log
+    # seed: seeds the call's noise and input diversification, see PerturbationEngine.perturb
+    # predictions: PredictionCache shared with the caller, so clean frames only go through the model once
+    # residency: DeviceResidency shared with the caller, which keeps the model on its device for the whole run
+    warm_start = sdbb is not None
+    if sdbb is None:
+        sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction, predictions=predictions,
+                                                     residency=residency)
     img_arr = [hashmap['image'] for hashmap in sequence]
     img_patches = [hashmap['bbox'][0] for hashmap in sequence]
     new_img_patches = []
@@ -1085,19 +1050,36 @@ def superdeepbillboard(model, sequence, direction, steering_vector, bb_size=5, i
         else:
             steering_vector.append(constraint)  # steering_vector[-1]+0.1
     tensorized_steering_vector = torch.as_tensor(np.array(steering_vector, dtype=np.float64), dtype=torch.float)
+    if population is not None:
+        perturbed_billboard_images, y, MAE, population_results = sdbb.perturb_population(img_arr, np.array(new_img_patches), model,
+                                                        tensorized_steering_vector, bb_size=bb_size, iterations=iterations,
+                                                        loss_fxn=loss_fxn, input_divers=input_divers, warm_start=warm_start,
+                                                        time_budget=time_budget, seed=seed, **population)
+        if step_log is not None:
+            step_log.append(dict(sdbb.stats, population=population_results))
+        return perturbed_billboard_images, y, MAE
     perturbed_billboard_images, y, MAE = sdbb.perturb_images(img_arr, np.array(new_img_patches), model,
                                                         tensorized_steering_vector, bb_size=bb_size,
                                                         iterations=iterations, noise_level=noise_level,
-                                                        last_billboard=last_billboard, loss_fxn=loss_fxn, input_divers=input_divers)
+                                                        last_billboard=last_billboard, loss_fxn=loss_fxn, input_divers=input_divers,
+                                                        warm_start=warm_start, refine_iterations=refine_iterations,
+                                                        time_budget=time_budget, stopping=stopping, seed=seed)
+    if step_log is not None:
+        step_log.append(dict(sdbb.stats))
     return perturbed_billboard_images, y, MAE
 
 def run_scenario(vehicle, bng, model, spawn, direction, run_number=0,
                                         collect_sequence_results=None,
-                                        bb_size=5, iterations=400, noise_level=25, dist_to_bb_cuton=37, resultsdir="images", input_divers=False):
+                                        bb_size=5, iterations=400, noise_level=25, dist_to_bb_cuton=37, resultsdir="images", input_divers=False,
+                                        stopping=None, seed=None):
     global centerline, default_spawnpoint, unperturbed_traj, unperturbed_steer
     starttime = time.time()
+    # the seed is saved with the results so the billboard can be regenerated
+    seed = seed if seed is not None else int(np.random.SeedSequence().generate_state(1)[0])
     sequence, unperturbed_results = run_scenario_to_collect_sequence(vehicle, bng, model, spawn, cuton=dist_to_bb_cuton)
-    pert_billboard, ys, MAE_collseq = deepbillboard(model, sequence, direction, bb_size=bb_size, iterations=iterations, noise_level=noise_level, input_divers=input_divers)
+    step_stats = []
+    pert_billboard, ys, MAE_collseq = deepbillboard(model, sequence, direction, bb_size=bb_size, iterations=iterations, noise_level=noise_level, input_divers=input_divers,
+                                                    stopping=stopping, step_log=step_stats, seed=seed)
     timetorun = time.time() - starttime
     print(f"Time to perturb: {timetorun:.1f}")
     plt.title("dbb final pert_billboard")
@@ -1119,6 +1101,9 @@ def run_scenario(vehicle, bng, model, spawn, direction, run_number=0,
     results['unperturbed_all_ys'] = unperturbed_results['all_ys']
     results["num_billboards"] = len(sequence)
     results["MAE_collection_sequence"] = MAE_collseq
+    results["stopping"] = repr(stopping)
+    results["step_stats"] = step_stats
+    results["seed"] = seed
     for i in range(10):
         runstarttime = time.time()
         perturbed_results = run_scenario_with_perturbed_billboard(vehicle, bng, model, spawn, pert_billboard,
@@ -1157,13 +1142,18 @@ def run_scenario(vehicle, bng, model, spawn, direction, run_number=0,
 
 def run_scenario_superdeepbillboard(vehicle, bng, model, spawn, direction, dist_to_bb_cuton=26, dist_to_bb_cutoff=0, run_number=0,
                                     collect_sequence_results=None,
-                                    bb_size=5, iterations=400, noise_level=25, resultsdir="images", input_divers=True, loss_fxn='inv23'):
+                                    bb_size=5, iterations=400, noise_level=25, resultsdir="images", input_divers=True, loss_fxn='inv23',
+                                    incremental=False, refine_iterations=25, population=None, time_budget=None, stopping=None,
+                                    seed=None):
     global default_spawnpoint, unperturbed_traj, unperturbed_steer
     starttime = time.time()
     pert_billboards, perturbation_run_results = run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction,
                                                                                 bb_size=bb_size, iterations=iterations, noise_level=noise_level,
                                                                                 dist_to_bb_cuton=dist_to_bb_cuton, dist_to_bb_cutoff=dist_to_bb_cutoff,
-                                                                                input_divers=input_divers, loss_fxn=loss_fxn)
+                                                                                input_divers=input_divers, loss_fxn=loss_fxn,
+                                                                                incremental=incremental, refine_iterations=refine_iterations,
+                                                                                population=population, time_budget=time_budget,
+                                                                                stopping=stopping, seed=seed)
     timetorun = time.time() - starttime
     print("Time to perturb:", timetorun)
     plt.title("sdbb final pert_billboard")
@@ -1186,6 +1176,13 @@ def run_scenario_superdeepbillboard(vehicle, bng, model, spawn, direction, dist_
     results['pertrun_dist'] = perturbation_run_results['avg_dist']
     results["num_billboards"] = perturbation_run_results["num_billboards"]
     results["MAE_collection_sequence"] = perturbation_run_results["MAE"]
+    results["incremental"] = incremental
+    results["refine_iterations"] = refine_iterations if incremental else None
+    results["population"] = population
+    results["time_budget"] = time_budget
+    results["stopping"] = repr(stopping)
+    results["step_stats"] = perturbation_run_results["step_stats"]
+    results["seed"] = perturbation_run_results["seed"]
     for i in range(10):
         # print(f"Run number {i}")
         runresults = run_scenario_with_perturbed_billboard(vehicle, bng, model, spawn, pert_billboards[-1], run_number=i,
@@ -1537,12 +1534,15 @@ def car_facing_billboard(vehicle_state):
 
 def run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction, dist_to_bb_cuton=26, dist_to_bb_cutoff=26,
                                         bb_size=5, iterations=100, noise_level=25, input_divers=True, loss_fxn='inv23',
-                                        device=torch.device('cuda')):
+                                        device=torch.device('cuda'), incremental=False, refine_iterations=25, population=None,
+                                        time_budget=None, stopping=None, seed=None):
     global new_results_dir, centerline, expected_trajectory, qr_positions
     global integral, prev_error, setpoint
     integral, runtime = 0.0, 0.0
     prev_error = setpoint
-    model = model.to(device)
+    # the model stays on the device for the whole run, the engines no longer move it to the CPU
+    residency = DeviceResidency.DeviceResidency(device)
+    model = residency.pin(model)
     bng.restart_scenario()
     vehicle.update_vehicle()
     sensors = bng.poll_sensors(vehicle)
@@ -1560,6 +1560,15 @@ def run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction, d
     detected_distances, distances = [], []
     qrbox_pos = list(qr_positions[0][0])  # bng.scenario._get_objects_list()[-1]['options']['position'][:2] #
     MAE = 0
+    # incremental mode keeps one engine for the whole run and refines its last perturbation at each step
+    # unperturbed predictions of the collected frames, computed once per frame and shared with the engines
+    clean_predictions = PredictionCache.PredictionCache(model, device=device)
+    sdbb = SuperDeepBillboard.SuperDeepBillboard(model, sequence, direction, predictions=clean_predictions,
+                                                 residency=residency) if incremental else None
+    step_stats = []
+    # every perturbation call gets its own seed derived from the run's seed, which is saved with the results
+    seed = seed if seed is not None else int(np.random.SeedSequence().generate_state(1)[0])
+    seeds = np.random.SeedSequence(seed)
     while damage <= 0:
         sensors = bng.poll_sensors(vehicle)
         last_steering_from_sim = sensors["electrics"]["steering_input"]
@@ -1620,9 +1629,12 @@ def run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction, d
             print(f"{len(sequence)=}, {len(steering_vector)=}")
             pert_billboard, y, MAE = superdeepbillboard(model, sequence, direction, copy.deepcopy(steering_vector),
                                                    bb_size=bb_size, iterations=iterations, noise_level=noise_level,
-                                                   dist_to_bb=dist_to_bb, input_divers=input_divers, loss_fxn=loss_fxn)
+                                                   dist_to_bb=dist_to_bb, input_divers=input_divers, loss_fxn=loss_fxn,
+                                                   sdbb=sdbb, refine_iterations=refine_iterations,
+                                                   population=population, time_budget=time_budget, stopping=stopping,
+                                                   step_log=step_stats, seed=int(seeds.spawn(1)[0].generate_state(1)[0]),
+                                                   predictions=clean_predictions, residency=residency)
             steering_vector.append(last_steering_from_sim)
-            model = model.to(device)
             ys = y
             pert_billboards.append(copy.deepcopy(pert_billboard))
             image = add_perturbed_billboard(origimage, pert_billboard, qr_corners[0])
@@ -1650,8 +1662,8 @@ def run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction, d
         all_ys.append(steering)
 
         if bbox_img is not None and kph > 29 and round(dist_to_bb,0) <= dist_to_bb_cuton:
-            origimg = model.process_image(np.asarray(origimage)).to(device)
-            unperturbed_predictions.append(float(model(origimg).cpu()[0][0]))
+            clean_prediction = clean_predictions.sync([hashmap['image'] for hashmap in sequence])[-1]
+            unperturbed_predictions.append(float(clean_prediction.cpu()[0]))
             perturbed_predictions.append(steering)
             angleerror_runtimes.append(runtime)
             traj.append(vehicle.state['front'])
@@ -1665,7 +1677,8 @@ def run_scenario_for_superdeepbillboard(vehicle, bng, model, spawn, direction, d
     deviation, dists, avg_dist = calc_deviation_from_center(centerline, traj)
     results = {'runtime': round(runtime, 3), 'damage': damage, 'kphs': kphs, 'traj': traj, 'final_img': final_img,
                'deviation': deviation, 'mse': mse, 'steering_vector': steering_vector, 'avg_dist': avg_dist, 'ys': ys,
-               "outcome":outcome, "all_ys": all_ys, "num_billboards": len(pert_billboards), "MAE": MAE
+               "outcome":outcome, "all_ys": all_ys, "num_billboards": len(pert_billboards), "MAE": MAE,
+               "step_stats": step_stats, "seed": seed
                }
     print(f"number of billboards: {len(pert_billboards)}")
     return pert_billboards, results
@@ -1694,6 +1707,18 @@ def main():
     rscs = [0.60]
     cutons = [20,24,28]
     input_divs = [True]
+    # True warm-starts each step from the previous perturbation and only refines it for refine_its iterations
+    incremental = False
+    refine_its = 25
+    # optimize several candidates per step in one batch instead of looping over noise levels, e.g.
+    # population = {"seeds": [None, 0, 1], "noise_levels": [10, 15, 25], "step_sizes": [0.01, 0.005]}
+    population = None
+    # wall-clock seconds per simulation step for generating the perturbation, None runs every iteration
+    time_budget = None
+    # end each perturbation early, e.g. [StoppingCriteria.LossPlateau(window=20, tol=1e-4), StoppingCriteria.Saturation()]
+    stopping = None
+    # seed of every run, None draws a fresh one; it is saved in the results pickle either way
+    seed = None
     vehicle, bng, model, spawn = setup_beamng(setup_args, vehicle_model='hopper', model_name=model_name)
     steps_per_sec = 15
     samples = 25
@@ -1703,7 +1728,9 @@ def main():
         os.mkdir("results/{}".format(newdir))
         print(f"Copying script to {os.getcwd()}/{__file__}")
         shutil.copy(f"{os.getcwd()}/{__file__}", f"results/{newdir}")
-        shutil.copy(f"{os.getcwd()}/../deepbillboard/SuperDeepBillboard.py", f"results/{newdir}")
+        # the whole package: SuperDeepBillboard is a thin wrapper around PerturbationEngine and its strategy modules
+        shutil.copytree(f"{os.getcwd()}/../deepbillboard", f"results/{newdir}/deepbillboard",
+                        ignore=shutil.ignore_patterns("__pycache__"))
     intake_lap_file(f"posefiles/DAVE2v3-lap-trajectory.txt")
     bng = create_ai_line_from_road_with_interpolation(spawn, bng, swerving=False)
 
@@ -1726,7 +1753,7 @@ def main():
                                         new_results_dir, training_file = make_results_dirs(newdir, technique, bbsize, nl, its, cuton, rsc, timestr)
                                         results = run_scenario(vehicle, bng, model, spawn, direction, collect_sequence_results=unperturbed_results,
                                                                                   bb_size=bbsize, iterations=its, noise_level=nl, dist_to_bb_cuton=cuton,
-                                                                                    resultsdir=new_results_dir)
+                                                                                    resultsdir=new_results_dir, stopping=stopping, seed=seed)
                                     elif technique == "dbb-orig":
                                         lossname = 'MDirE'
                                         new_results_dir, training_file = make_results_dirs(newdir, technique, bbsize, 1000,
@@ -1735,7 +1762,7 @@ def main():
                                                                collect_sequence_results=unperturbed_results,
                                                                bb_size=bbsize, iterations=its, noise_level=1000,
                                                                dist_to_bb_cuton=28,
-                                                               resultsdir=new_results_dir, input_divers=False)
+                                                               resultsdir=new_results_dir, input_divers=False, stopping=stopping, seed=seed)
                                     elif technique == "dbb-plus":
                                         lossname = 'MDirE'
                                         new_results_dir, training_file = make_results_dirs(newdir, technique, bbsize, 15,
@@ -1743,14 +1770,18 @@ def main():
                                         results = run_scenario(vehicle, bng, model, spawn, direction,
                                                                collect_sequence_results=unperturbed_results,
                                                                bb_size=bbsize, iterations=its, noise_level=15,
-                                                               dist_to_bb_cuton=40, input_divers=input_div, resultsdir=new_results_dir)
+                                                               dist_to_bb_cuton=40, input_divers=input_div, resultsdir=new_results_dir,
+                                                               stopping=stopping, seed=seed)
                                     else:
                                         lossname = 'inv23' # 'MDirE'
                                         new_results_dir, training_file = make_results_dirs(newdir, technique, bbsize, nl,
                                                                                            its, cuton, rsc, input_div, timestr)
                                         results = run_scenario_superdeepbillboard(vehicle, bng, model, spawn, direction, collect_sequence_results=unperturbed_results,
                                                                                   bb_size=bbsize, iterations=its, noise_level=nl, dist_to_bb_cuton=cuton,
-                                                                                  dist_to_bb_cutoff=rsc, resultsdir=new_results_dir, input_divers=input_div, loss_fxn=lossname)
+                                                                                  dist_to_bb_cutoff=rsc, resultsdir=new_results_dir, input_divers=input_div, loss_fxn=lossname,
+                                                                                  incremental=incremental, refine_iterations=refine_its,
+                                                                                  population=population, time_budget=time_budget,
+                                                                                  stopping=stopping, seed=seed)
                                         all_trajs.append(results["pertrun_traj"])
                                         all_outcomes.append(results["pertrun_outcome"])
                                     # plot_errors(results['testruns_error'], training_file.replace(".pickle", ".png"))
@@ -3,6 +3,7 @@ import os.path
 import cv2
 import random
 import numpy as np
+from centerline import centerline_index
 from matplotlib import pyplot as plt
 import logging
 from beamngpy import BeamNGpy, Scenario, Vehicle, setup_logging, StaticObject, ScenarioObject
@@ -208,51 +209,12 @@ def plot_deviation(trajectories, model, deflation_pattern, centerline):
     plt.pause(0.1)
     return
 
-def lineseg_dists(p, a, b):
-    """Cartesian distance from point to line segment
-    Edited to support arguments as series, from:
-    https://stackoverflow.com/a/54442561/11208892
-    Args:
-        - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-        - a: np.array of shape (x, 2)
-        - b: np.array of shape (x, 2)
-    """
-    # normalized tangent vectors
-    d_ba = b - a
-    d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-    # signed parallel distance components
-    # rowwise dot products of 2D vectors
-    s = np.multiply(a - p, d).sum(axis=1)
-    t = np.multiply(p - b, d).sum(axis=1)
-
-    # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-    # perpendicular distance component
-    # rowwise cross products of 2D vectors
-    d_pa = p - a
-    c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-    return np.hypot(h, c)
-
 #return distance between two 3d points
 def distance(a, b):
     return math.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2)
 
-def dist_from_line(centerline, point):
-    a = [[x[0],x[1]] for x in centerline[:-1]]
-    b = [[x[0],x[1]] for x in centerline[1:]]
-    a = np.array(a)
-    b = np.array(b)
-    dist = lineseg_dists([point[0], point[1]], a, b)
-    return dist
-
 def calc_deviation_from_center(centerline, traj):
-    dists = []
-    for point in traj:
-        dist = dist_from_line(centerline, point)
-        dists.append(min(dist))
+    dists = list(centerline_index(centerline).distances(traj))
     stddev = statistics.stdev(dists)
     return stddev
 
@@ -410,9 +372,9 @@ def create_ai_line_from_road_with_interpolation(spawn, bng):
 def has_car_left_track(vehicle_pos, vehicle_bbox, bng):
     global centerline_interpolated
     # get nearest road point
-    distance_from_centerline = dist_from_line(centerline_interpolated, vehicle_pos)
-    # print("Distance from center of road:", min(distance_from_centerline))
-    return min(distance_from_centerline) > 9.0
+    distance_from_centerline = centerline_index(centerline_interpolated).distance(vehicle_pos)
+    # print("Distance from center of road:", distance_from_centerline)
+    return distance_from_centerline > 9.0
 
 def find_width_of_road(bng):
     edges = bng.get_road_edges('7983')
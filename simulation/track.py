@@ -1,4 +1,7 @@
 import numpy as np
+from centerline import centerline_index
+from trackgeometry import read_lap_file
+from waypoints import WaypointFollower
 from matplotlib import pyplot as plt
 import random, copy
 
@@ -19,6 +22,7 @@ class Track():
         self.swerving = swerving
         self.swervingstdev = swervingstdev
         self.remaining_centerline = []
+        self.follower = None
         self.centerline = []
         self.centerline_interpolated = []
         self.roadleft = []
@@ -212,34 +216,6 @@ class Track():
         r = R.from_euler('xyz', r, degrees=True)
         return tuple(r.as_quat())
 
-    def lineseg_dists(self, p, a, b):
-        """Cartesian distance from point to line segment
-        Edited to support arguments as series, from:
-        https://stackoverflow.com/a/54442561/11208892
-        Args:
-            - p: np.array of single point, shape (2,) or 2D array, shape (x, 2)
-            - a: np.array of shape (x, 2)
-            - b: np.array of shape (x, 2)
-        """
-        # normalized tangent vectors
-        d_ba = b - a
-        d = np.divide(d_ba, (np.hypot(d_ba[:, 0], d_ba[:, 1]).reshape(-1, 1)))
-
-        # signed parallel distance components
-        # rowwise dot products of 2D vectors
-        s = np.multiply(a - p, d).sum(axis=1)
-        t = np.multiply(p - b, d).sum(axis=1)
-
-        # clamped parallel distance
-        h = np.maximum.reduce([s, t, np.zeros(len(s))])
-
-        # perpendicular distance component
-        # rowwise cross products of 2D vectors
-        d_pa = p - a
-        c = d_pa[:, 0] * d[:, 1] - d_pa[:, 1] * d[:, 0]
-
-        return np.hypot(h, c)
-
     def turn_90(self, rot_quat):
         r = R.from_quat(list(rot_quat))
         r = r.as_euler('xyz', degrees=True)
@@ -503,6 +479,9 @@ class Track():
         centerline = copy.deepcopy(traj)
         remaining_centerline = copy.deepcopy(traj)
         centerline_interpolated = copy.deepcopy(traj)
+        self.centerline = centerline
+        self.centerline_interpolated = centerline_interpolated
+        self.follower = WaypointFollower(traj)
         # for i in range(4):
         #     centerline.extend(copy.deepcopy(centerline))
         #     remaining_centerline.extend(copy.deepcopy(remaining_centerline))
@@ -522,11 +501,7 @@ class Track():
         return dist1 + dist2
 
     def returned_to_expected_traj(self, pos_window):
-        global expected_trajectory
-        dists = []
-        for point in pos_window:
-            dist = dist_from_line(expected_trajectory, point)
-            dists.append(min(dist))
+        dists = list(centerline_index(self.expected_trajectory).distances(pos_window))
         avg_dist = sum(dists) / len(dists)
         return avg_dist < 1
 
@@ -561,41 +536,32 @@ class Track():
 
 
     def dist_from_line(self, centerline, point):
-        a = [[x[0],x[1]] for x in centerline[:-1]]
-        b = [[x[0],x[1]] for x in centerline[1:]]
-        a = np.array(a)
-        b = np.array(b)
-        dist = self.lineseg_dists([point[0], point[1]], a, b)
-        return dist
+        return centerline_index(centerline).segment_distances(point)
 
 
     def intake_lap_file(self, filename="DAVE2v1-lap-trajectory.txt"):
-        expected_trajectory = []
-        with open(filename, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                line = line.replace("\n", "")
-                line = literal_eval(line)
-                expected_trajectory.append(line)
+        expected_trajectory = read_lap_file(filename)
         return expected_trajectory
 
 
     # track is approximately 12.50m wide
     # car is approximately 1.85m wide
     def has_car_left_track(self, vehicle_pos, vehicle_bbox, bng):
-        global centerline_interpolated
         # get nearest road point
-        distance_from_centerline = self.dist_from_line(centerline_interpolated, vehicle_pos)
+        distance_from_centerline = centerline_index(self.centerline_interpolated).distance(vehicle_pos)
         # check if it went over left edge
-        # print("Distance from center of road:", min(distance_from_centerline))
-        return min(distance_from_centerline) > 15.0
-
-
-    def laps_completed(self, lapcount):
-        global centerline_interpolated, remaining_centerline
-        remainder = centerline_interpolated.index(remaining_centerline[0])
-        remainder = remainder / len(centerline_interpolated)
-        return lapcount + remainder
+        # print("Distance from center of road:", distance_from_centerline)
+        return distance_from_centerline > 15.0
+
+
+    def laps_completed(self, lapcount, vehicle_pos=None):
+        # the fraction of the current lap comes from the waypoint nearest to vehicle_pos; nothing else moves the
+        # follower, so without a position only the whole laps are counted
+        if vehicle_pos is None:
+            return lapcount
+        nearest, _ = centerline_index(self.centerline_interpolated).nearest(vehicle_pos)
+        self.follower.advance((nearest - self.follower.index()) % len(self.follower))
+        return lapcount + self.follower.lap_fraction()
 
 
     def adjust_centerline_for_spawn(self):
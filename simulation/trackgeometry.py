@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import os
+from ast import literal_eval
+
+import numpy as np
+
+from waypoints import WaypointFollower, segment_headings
+
+# usage: python trackgeometry.py [posefiles/*-lap-trajectory.txt] [--tracks tracks/*.npz]
+# compiles lap files ahead of time and prints what the compiled tracks hold, no simulator needed
+
+TRACKS_DIR = "tracks"
+
+
+def parse_lap_file(filename):
+    # the text of a lap file (one [x, y, z] per line) as an (N, 3) array
+    with open(filename, 'r') as f:
+        return np.array([literal_eval(line) for line in f if line.strip()], dtype=float)
+
+
+def compile_lap_file(filename):
+    """Parses a lap file once and saves it as a .npy next to it, which read_lap_file then memory-maps."""
+    traj = parse_lap_file(filename)
+    compiled = os.path.splitext(filename)[0] + ".npy"
+    np.save(compiled, traj)
+    return compiled, traj
+
+
+def read_lap_file(filename):
+    """Trajectory in a lap file (one [x, y, z] per line) as an (N, 3) array.
+
+    Memory-maps the .npy compile_lap_file made of it, unless there is
+    none or the text file is newer, in which case the text is parsed.
+    Nothing is written.
+    """
+    compiled = os.path.splitext(filename)[0] + ".npy"
+    if os.path.isfile(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(filename):
+        return np.load(compiled, mmap_mode="r")
+    return parse_lap_file(filename)
+
+
+def interpolate_centerline(middle):
+    # the closed polyline middle resampled at 1m, what the per-segment interp1d loop of
+    # create_ai_line_from_road_with_interpolation produced: a segment longer than 1m becomes int(length) evenly spaced
+    # points from its start to its end at the height of its start, shorter ones keep just their start
+    middle = np.asarray(middle, dtype=float)
+    p, q = middle[:-1], middle[1:]
+    lengths = np.linalg.norm(q - p, axis=1)
+    num = np.where(lengths > 1, lengths.astype(int), 1)
+    seg = np.repeat(np.arange(len(p)), num)
+    k = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+    last = np.maximum(num[seg] - 1, 1)
+    t = (k / last)[:, None]
+    traj = p[seg].copy()
+    traj[:, :2] = np.where(k[:, None] == last[:, None], q[seg, :2], p[seg, :2] + t * (q[seg, :2] - p[seg, :2]))
+    return traj
+
+
+def track_path(scenario, spawnpoint, road_id=None, directory=TRACKS_DIR):
+    name = f"{scenario}-{spawnpoint}" if road_id is None else f"{scenario}-{spawnpoint}-{road_id}"
+    return os.path.join(directory, f"{name}.npz")
+
+
+class TrackGeometry():
+    """The road geometry of one track and spawn point, compiled into a single .npz.
+
+    Stands in for bng in road_analysis: get_road_edges(road_id) and
+    get_roads() answer from the compiled track, and only ask the
+    simulator, if there is one, for roads that were never compiled.
+    centerline(middle) gives the 1m interpolated centerline of the
+    adjusted middle road_analysis derived from those edges, keyed by a
+    digest of middle so the scripts' different adjustments do not clash,
+    and follower(middle) a WaypointFollower on it with its segment
+    headings.
+    save() writes whatever was added since the track was loaded, so the
+    simulator is queried once per track and every later start, with or
+    without BeamNG running, loads the .npz in a few milliseconds.
+    """
+
+    def __init__(self, scenario, spawnpoint, road_id=None, bng=None, directory=TRACKS_DIR):
+        self.scenario = scenario
+        self.spawnpoint = spawnpoint
+        self.road_id = road_id
+        self.bng = bng
+        self.path = track_path(scenario, spawnpoint, road_id, directory)
+        self.edges, self.centerlines, self.headings, self.roads = {}, {}, {}, None
+        self._dirty = False
+        if os.path.isfile(self.path):
+            with np.load(self.path) as track:
+                for key in track.files:
+                    if key.startswith("edges_"):
+                        self.edges[key[len("edges_"):]] = track[key]
+                    elif key.startswith("centerline_"):
+                        self.centerlines[key[len("centerline_"):]] = track[key]
+                    elif key.startswith("headings_"):
+                        self.headings[key[len("headings_"):]] = track[key]
+                    elif key == "roads":
+                        self.roads = [str(road) for road in track[key]]
+
+    def _simulator(self, what):
+        if self.bng is None:
+            raise ValueError(f"{what} is not compiled into {self.path} and there is no simulator to ask")
+        return self.bng
+
+    def get_roads(self):
+        if self.roads is None:
+            self.roads = [str(road) for road in self._simulator("The road list").get_roads()]
+            self._dirty = True
+        return {road: {} for road in self.roads}
+
+    def get_road_edges(self, road_id):
+        # the same list of {'left', 'middle', 'right'} dicts as bng.get_road_edges
+        road_id = str(road_id)
+        if road_id not in self.edges:
+            edges = self._simulator(f"Road {road_id}").get_road_edges(road_id)
+            self.edges[road_id] = np.array([[edge['left'], edge['middle'], edge['right']] for edge in edges], dtype=float)
+            self._dirty = True
+        return [{'left': list(edge[0]), 'middle': list(edge[1]), 'right': list(edge[2])} for edge in self.edges[road_id]]
+
+    @staticmethod
+    def digest(middle):
+        return hashlib.sha1(np.asarray(middle, dtype=float).tobytes()).hexdigest()[:16]
+
+    def centerline(self, middle):
+        key = self.digest(middle)
+        if key not in self.centerlines:
+            self.centerlines[key] = interpolate_centerline(middle)
+            self._dirty = True
+        return self.centerlines[key]
+
+    def follower(self, middle):
+        centerline = self.centerline(middle)
+        key = self.digest(middle)
+        if key not in self.headings:
+            self.headings[key] = segment_headings(centerline)
+            self._dirty = True
+        return WaypointFollower(centerline, headings=self.headings[key])
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        arrays = {f"edges_{road}": edges for road, edges in self.edges.items()}
+        arrays.update({f"centerline_{key}": traj for key, traj in self.centerlines.items()})
+        arrays.update({f"headings_{key}": headings for key, headings in self.headings.items()})
+        if self.roads is not None:
+            arrays["roads"] = np.array(self.roads)
+        np.savez(self.path, **arrays)
+        self._dirty = False
+
+    def __repr__(self):
+        return (f"TrackGeometry({self.path}: roads {sorted(self.edges)}, "
+                f"centerlines {[len(traj) for traj in self.centerlines.values()]})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lap_files", type=str, nargs="*")
+    parser.add_argument("--tracks", type=str, nargs="*", default=[])
+    args = parser.parse_args()
+    for filename in args.lap_files:
+        compiled, traj = compile_lap_file(filename)
+        print(f"{filename}: {len(traj)} points, compiled into {compiled}")
+    for path in args.tracks:
+        with np.load(path) as track:
+            for key in track.files:
+                print(f"{path} {key}: {track[key].shape}")
+
+
+if __name__ == "__main__":
+    main()
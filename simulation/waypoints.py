@@ -0,0 +1,155 @@
+import math
+
+import numpy as np
+
+
+def wrap_angle(a):
+    # same as math.atan2(math.sin(a), math.cos(a)), elementwise
+    return np.arctan2(np.sin(a), np.cos(a))
+
+
+def packed(points):
+    return np.asarray([[p[0], p[1]] for p in points], dtype=float)
+
+
+def segment_lengths(points):
+    # length of segment i, from waypoint i to waypoint i + 1; the last one closes the loop
+    d = np.roll(points, -1, axis=0) - points
+    return np.hypot(d[:, 0], d[:, 1])
+
+
+def segment_headings(points):
+    # heading of segment i; zero-length segments (repeated waypoints) keep the heading before them
+    d = np.roll(points, -1, axis=0) - points
+    lengths = np.hypot(d[:, 0], d[:, 1])
+    headings = np.arctan2(d[:, 1], d[:, 0])
+    valid = np.nonzero(lengths > 0)[0]
+    if len(valid):
+        last = np.maximum.accumulate(np.where(lengths > 0, np.arange(len(points)), -1))
+        headings = headings[np.where(last >= 0, last, valid[-1])]
+    return headings
+
+
+class WaypointFollower():
+    """Integer cursor into a closed loop of waypoints such as the interpolated centerline.
+
+    The waypoints are packed into an (n, 2) array once; the cursor counts
+    every waypoint passed so far and wraps around the loop by index
+    arithmetic, so following the line never copies or extends it.
+    offset k always means the k-th waypoint after the cursor. Segment i
+    runs from waypoint i to waypoint i + 1 (the last one closes the loop);
+    arc_lengths[i] is the distance along the loop from waypoint 0 to
+    waypoint i and arc_lengths[n] the lap length. headings are the
+    segment_headings(), passed in when the track has them compiled.
+    """
+
+    def __init__(self, points, cursor=0, headings=None):
+        self.points = packed(points)
+        if len(self.points) < 2:
+            raise ValueError("WaypointFollower needs at least two waypoints")
+        self.cursor = cursor
+        self.lengths = segment_lengths(self.points)
+        self.arc_lengths = np.concatenate(([0.0], np.cumsum(self.lengths)))
+        self.headings = segment_headings(self.points) if headings is None else np.asarray(headings)
+        # the headings unwrapped along two laps back to back, so any window of segments is a slice
+        unwrapped = self.headings[0] + np.concatenate(([0.0], np.cumsum(wrap_angle(np.diff(self.headings)))))
+        lap_turn = unwrapped[-1] + wrap_angle(self.headings[0] - self.headings[-1]) - unwrapped[0]
+        self.unwrapped = np.concatenate((unwrapped, unwrapped + lap_turn))
+
+    def __len__(self):
+        return len(self.points)
+
+    def reset(self, cursor=0):
+        self.cursor = cursor
+
+    def advance(self, count):
+        self.cursor += int(count)
+
+    def index(self, offset=0):
+        return (self.cursor + offset) % len(self.points)
+
+    def waypoint(self, offset=0):
+        return self.points[self.index(offset)]
+
+    def window(self, start, stop):
+        # the waypoints at offsets start..stop-1, wrapping around the loop; a view unless the window wraps
+        i = self.index(start)
+        if i + stop - start <= len(self.points):
+            return self.points[i:i + stop - start]
+        return self.points[(i + np.arange(stop - start)) % len(self.points)]
+
+    def distances(self, pos, start, stop):
+        d = self.window(start, stop) - (pos[0], pos[1])
+        return np.hypot(d[:, 0], d[:, 1])
+
+    def angles(self, vehicle_state, start, stop):
+        # angle_between(waypoint, vehicle_state) for the waypoints at offsets start..stop-1: the angle from the
+        # vehicle's heading to each of them, positive to the right
+        pos, front = vehicle_state['pos'], vehicle_state['front']
+        vehicle_angle = math.atan2(front[1] - pos[1], front[0] - pos[0])
+        d = self.window(start, stop) - (pos[0], pos[1])
+        return wrap_angle(vehicle_angle - np.arctan2(d[:, 1], d[:, 0]))
+
+    def first_beyond(self, pos, radius, start=0):
+        # offset of the first waypoint from start on that is at least radius away from pos, what
+        # `while distance2D(pos, remaining[i]) < radius: i += 1` stops at; searched in growing windows
+        size, end = 32, start + len(self.points)
+        while start < end:
+            stop = min(start + size, end)
+            beyond = self.distances(pos, start, stop) >= radius
+            k = int(beyond.argmax())
+            if beyond[k]:
+                return start + k
+            start, size = stop, size * 2
+        raise ValueError(f"No waypoint is {radius}m away from {pos}")
+
+    def lookahead(self, vehicle_state, radius, count=10):
+        # distances and angles() of the waypoints from the cursor up to the first one at least radius away from the
+        # vehicle (and at least count of them), in one pass over a window that grows only when the vehicle is lagging
+        pos, front = vehicle_state['pos'], vehicle_state['front']
+        size = max(count, 32)
+        while True:
+            d = self.window(0, size) - (pos[0], pos[1])
+            dists = np.hypot(d[:, 0], d[:, 1])
+            beyond = dists >= radius
+            k = int(beyond.argmax())
+            if beyond[k]:
+                break
+            if size >= len(self.points):
+                raise ValueError(f"No waypoint is {radius}m away from {pos}")
+            size *= 2
+        stop = max(k + 1, count)
+        vehicle_angle = math.atan2(front[1] - pos[1], front[0] - pos[0])
+        return dists[:stop], wrap_angle(vehicle_angle - np.arctan2(d[:stop, 1], d[:stop, 0]))
+
+    def angle_bounds(self, vehicle_state, start, stop):
+        # (lowest, highest) that angles(vehicle_state, start, stop) can be, from one bearing and the headings: the
+        # waypoints after the first lie along segments start..stop-2 beyond it, so while the bearing of the first and
+        # the headings of those segments fit within less than half a turn, so do the bearings of all of them.
+        # (-pi, pi) when they do not
+        pos, front = vehicle_state['pos'], vehicle_state['front']
+        vehicle_angle = math.atan2(front[1] - pos[1], front[0] - pos[0])
+        p = self.waypoint(start)
+        bearing = math.atan2(p[1] - pos[1], p[0] - pos[0])
+        s = self.index(start)
+        headings = self.unwrapped[s:s + stop - start - 1]
+        if len(headings):
+            ref = float(headings[0])
+            bearing = ref + math.atan2(math.sin(bearing - ref), math.cos(bearing - ref))
+            lo, hi = min(bearing, float(headings.min())), max(bearing, float(headings.max()))
+        else:
+            lo = hi = bearing
+        if hi - lo >= math.pi:
+            return -math.pi, math.pi
+        mid, half = (lo + hi) / 2, (hi - lo) / 2
+        a = vehicle_angle - mid
+        a = math.atan2(math.sin(a), math.cos(a))
+        # widened a little for rounding, the bounds are compared against thresholds the angles must not pass
+        return a - half - 1e-9, a + half + 1e-9
+
+    def lap_fraction(self):
+        # how far through the current lap the cursor is, as a fraction of the waypoints
+        return self.index() / len(self.points)
+
+    def __repr__(self):
+        return f"WaypointFollower({len(self.points)} waypoints, cursor={self.cursor})"
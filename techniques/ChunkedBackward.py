@@ -0,0 +1,143 @@
+import sys
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def reset_peak_rss():
+    # starts a new peak RSS window, so peak_rss() measures from here on; only Linux can reset it (clear_refs),
+    # elsewhere peak_rss() stays the peak of the whole process lifetime and this returns False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    # peak resident set size in bytes since the last reset_peak_rss() on Linux, over the process lifetime
+    # elsewhere; None where it cannot be read
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return rss if sys.platform == "darwin" else rss * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return getattr(memory, "peak_wset", memory.rss)
+
+
+class ChunkedBackward():
+    """Backpropagates the loss of a sequence through the model a chunk of frames at a time.
+
+    The frames are first run through the model chunk by chunk without
+    keeping activations, the loss and its gradient w.r.t. the predictions
+    are computed for the whole sequence, and every chunk is then run again
+    and backpropagated with its part of that gradient. The gradients of
+    the frames are collected and pushed through the compositing, noise and
+    diversification in one final backward pass, so the texture gradient
+    is the unchunked one for every loss (up to float summation order),
+    while only one chunk's activations are alive at a time. The model has
+    to be deterministic (eval mode) for both passes to agree.
+
+    The chunk size is chunk_size, or the largest that keeps the estimated
+    activations of a chunk under memory_budget bytes. The budget bounds
+    the model's activations only: the composited frames of the whole
+    sequence, their full-size gradient buffer and the predictions stay
+    alive for the entire backward pass, as does anything the caller
+    holds. With checkpoint the
+    conv stack of models with conv_stages() keeps only the outputs of
+    every segment of stages_per_segment stages and recomputes the rest in
+    the backward pass.
+    """
+
+    def __init__(self, chunk_size=None, memory_budget=None, checkpoint=False, stages_per_segment=3):
+        if chunk_size is None and memory_budget is None:
+            raise ValueError("ChunkedBackward needs a chunk_size or a memory_budget")
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.checkpoint = checkpoint
+        self.stages_per_segment = stages_per_segment
+        self._frame_bytes = {}
+
+    def segments(self, model):
+        stages = model.conv_stages()
+        return [stages[i:i + self.stages_per_segment] for i in range(0, len(stages), self.stages_per_segment)]
+
+    @staticmethod
+    def run_stages(stages, x):
+        for stage in stages:
+            x = stage(x)
+        return x
+
+    def forward(self, model, x):
+        if not self.checkpoint or not hasattr(model, "conv_stages"):
+            return model(x)
+        for segment in self.segments(model):
+            x = checkpoint(self.run_stages, segment, x, use_reentrant=False)
+        return model.dense_head(x)
+
+    def frame_bytes(self, model, frame):
+        # estimated bytes of the activations one frame keeps alive for the backward pass
+        key = (id(model), tuple(frame.shape), frame.dtype, self.checkpoint)
+        if key not in self._frame_bytes:
+            x = frame[None]
+            sizes = [x.numel() * x.element_size()]
+            with torch.no_grad():
+                if hasattr(model, "conv_stages"):
+                    for segment in self.segments(model):
+                        segment_sizes = []
+                        for stage in segment:
+                            x = stage(x)
+                            segment_sizes.append(x.numel() * x.element_size())
+                        sizes.append(segment_sizes[-1] if self.checkpoint else sum(segment_sizes))
+                    x = model.dense_head(x)
+                else:
+                    x = model(x)
+            sizes.append(x.numel() * x.element_size())
+            self._frame_bytes[key] = sum(sizes)
+        return self._frame_bytes[key]
+
+    def size_for(self, model, imgs):
+        if self.chunk_size is not None:
+            return self.chunk_size
+        return max(1, int(self.memory_budget // self.frame_bytes(model, imgs[0])))
+
+    def backward(self, model, imgs, loss_fxn, target):
+        # runs loss_fxn(model(imgs), target).backward() chunk by chunk, returns the detached predictions and loss
+        chunk = self.size_for(model, imgs)
+        x = imgs.detach()
+        with torch.no_grad():
+            y = torch.cat([model(x_c) for x_c in x.split(chunk)])
+        y.requires_grad = True
+        loss = loss_fxn(y, target)
+        loss.backward()
+        grad_imgs = torch.empty_like(x)
+        for x_c, g_c, grad_c in zip(x.split(chunk), y.grad.split(chunk), grad_imgs.split(chunk)):
+            x_c = x_c.detach()
+            x_c.requires_grad = True
+            self.forward(model, x_c).backward(g_c)
+            grad_c.copy_(x_c.grad)
+        if imgs.requires_grad:
+            imgs.backward(grad_imgs)
+        return y.detach(), loss.detach()
+
+    def __repr__(self):
+        return (f"ChunkedBackward(chunk_size={self.chunk_size}, memory_budget={self.memory_budget}, "
+                f"checkpoint={self.checkpoint})")
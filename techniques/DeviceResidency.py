@@ -0,0 +1,33 @@
+import torch
+
+
+class DeviceResidency():
+    """Keeps the model and the frames of a run on one device.
+
+    The model is moved to the device once, when it is first pinned, and
+    stays there: the engines optimize and evaluate on that device and
+    only copy the final uint8 billboard (and the small prediction and
+    score tensors) back to the host. Share one instance between the
+    engines and the simulation loop of a run. Every model is moved once,
+    whatever the device, so a model left on the GPU by an earlier run
+    comes back to the CPU when the residency is on the CPU.
+    """
+
+    def __init__(self, device=torch.device("cuda")):
+        self.device = torch.device(device)
+        # ids of the modules already moved to the device
+        self.pinned = set()
+
+    @property
+    def active(self):
+        return self.device.type != "cpu"
+
+    def pin(self, model):
+        if id(model) not in self.pinned:
+            model.to(self.device)
+            self.pinned.add(id(model))
+        return model
+
+    def billboard(self, perturbation):
+        # rounds on the device and copies out only the HxWx3 uint8 billboard of the last texture
+        return torch.round(perturbation[-1].detach().permute(1, 2, 0) * 255).to(torch.uint8).cpu().numpy()
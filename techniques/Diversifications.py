@@ -0,0 +1,79 @@
+import kornia
+import numpy as np
+import torch
+
+
+class Diversification():
+    """Augments the composited frames of each iteration.
+
+    __call__(imgs, target, rng) returns the augmented frames and the
+    matching steering targets, drawing its randomness from the numpy
+    Generator rng (a fresh one when None). before_noise decides whether
+    the engine applies it to the frames before or after the sensor noise
+    is added.
+    """
+
+    name = "diversification"
+    before_noise = False
+
+    def __call__(self, imgs, target, rng=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v}" for k, v in vars(self).items() if not k.startswith("_"))
+        return f"{type(self).__name__}({params})"
+
+
+class RandomAffine(Diversification):
+    """Appends one randomly transformed copy of a randomly chosen frame per frame.
+
+    Each copy is rescaled by a factor in [min_scale, max_scale], rotated
+    by up to rotation degrees, shifted by up to translation times the
+    frame size and has its brightness multiplied by a factor in
+    [1 - brightness, 1 + brightness]. All copies are drawn at once and
+    warped with a single batched affine warp.
+    """
+
+    name = "random_affine"
+
+    def __init__(self, min_scale=0.5, max_scale=2.0, rotation=0.0, translation=0.0, brightness=0.0, before_noise=False):
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.rotation = rotation
+        self.translation = translation
+        self.brightness = brightness
+        self.before_noise = before_noise
+
+    def sample(self, n, rng):
+        index = rng.integers(0, n, size=n)
+        scales = rng.uniform(self.min_scale, self.max_scale, size=n)
+        angles = rng.uniform(-self.rotation, self.rotation, size=n) if self.rotation else np.zeros(n)
+        shifts = rng.uniform(-self.translation, self.translation, size=(n, 2)) if self.translation else None
+        gains = rng.uniform(1 - self.brightness, 1 + self.brightness, size=n) if self.brightness else None
+        return index, scales, angles, shifts, gains
+
+    def __call__(self, imgs, target, rng=None):
+        n, _, h, w = imgs.shape
+        rng = rng if rng is not None else np.random.default_rng()
+        index, scales, angles, shifts, gains = self.sample(n, rng)
+        device = imgs.device
+        index = torch.as_tensor(index, device=device)
+        scales = torch.as_tensor(scales, dtype=torch.float, device=device)[:, None].repeat(1, 2)
+        angles = torch.as_tensor(angles, dtype=torch.float, device=device)
+        center = torch.tensor([[(w - 1) / 2, (h - 1) / 2]], device=device).expand(n, 2)
+        matrix = kornia.geometry.transform.get_rotation_matrix2d(center, angles, scales)
+        if shifts is not None:
+            matrix[:, :, 2] += torch.as_tensor(shifts, dtype=torch.float, device=device) * torch.tensor([w, h], device=device)
+        warped = kornia.geometry.transform.affine(imgs[index], matrix[..., :2, :3])
+        if gains is not None:
+            warped = torch.clamp(warped * torch.as_tensor(gains, dtype=torch.float, device=device)[:, None, None, None], 0, 1)
+        return torch.cat((imgs, warped)), torch.cat((target, target[index]), dim=0)
+
+
+class RandomScale(RandomAffine):
+    """Appends one copy of a randomly chosen frame, rescaled by a factor in [min_scale, max_scale], per frame."""
+
+    name = "random_scale"
+
+    def __init__(self, min_scale=0.5, max_scale=2.0, before_noise=False):
+        super().__init__(min_scale, max_scale, before_noise=before_noise)
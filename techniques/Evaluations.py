@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+from torchvision.utils import save_image
+
+
+# angle1 in blue, angle2 in green
+def draw_arrows(img, angle1, angle2=None):
+    import cv2
+
+    img = (img.transpose((1, 2, 0)) * 255).round().astype(np.uint8).copy()
+
+    pt1 = (int(img.shape[1] / 2), img.shape[0])
+    pt2_angle1 = (
+        int(img.shape[1] / 2 - img.shape[0] / 3 * np.sin(angle1)),
+        int(img.shape[0] - img.shape[0] / 3 * np.cos(angle1)),
+    )
+    img = cv2.arrowedLine(img, pt1, pt2_angle1, (0, 0, 255), 3)
+    if angle2 is not None:
+        angle2 = -angle2
+        pt2_angle2 = (
+            int(img.shape[1] / 2 - img.shape[0] / 3 * np.sin(angle2)),
+            int(img.shape[0] - img.shape[0] / 3 * np.cos(angle2)),
+        )
+        img = cv2.arrowedLine(img, pt1, pt2_angle2, (0, 255, 0), 3)
+
+    return img.astype(np.float32).transpose((2, 0, 1)) / 255
+
+
+class Evaluation():
+    """Scores the final billboard once the loop is done.
+
+    Called under no_grad with the model, the clean and the perturbed
+    frames, the optimization device they all live on and the cached
+    clean predictions (see PredictionCache). Returns a tuple that the
+    engine appends to its (bb, y) result.
+    """
+
+    name = "evaluation"
+
+    def __call__(self, model, imgs, perturbed_imgs, device, orig_angles=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+
+
+class SteeringMAE(Evaluation):
+    """Mean difference between the clean and the perturbed steering angles, returned as a CPU scalar tensor."""
+
+    name = "steering_mae"
+
+    def __call__(self, model, imgs, perturbed_imgs, device, orig_angles=None):
+        orig_angles = orig_angles if orig_angles is not None else model(imgs)
+        pert_angles = model(perturbed_imgs)
+        MAE = (orig_angles - pert_angles).mean().cpu()
+        return (MAE,)
+
+
+class ArrowImages(Evaluation):
+    """Draws the clean (blue) and perturbed (green) steering angles into the perturbed frames.
+
+    The frames are saved to sample_dir/arrows_<number of frames>.png and
+    returned together with the perturbed frames, both on the CPU.
+    """
+
+    name = "arrow_images"
+
+    def __init__(self, sample_dir):
+        self.sample_dir = sample_dir
+
+    def __call__(self, model, imgs, perturbed_imgs, device, orig_angles=None):
+        orig_angles = (orig_angles if orig_angles is not None else model(imgs)).cpu()
+        pert_angles = model(perturbed_imgs).cpu()
+        perturbed_imgs = perturbed_imgs.cpu()
+        print("Original outputs:", orig_angles)
+        print("Adversarial outputs:", pert_angles)
+        arrowed_imgs = []
+        for pert_img, a1, a2 in zip(perturbed_imgs, orig_angles, pert_angles):
+            arrowed_imgs.append(draw_arrows(pert_img.numpy(), a1.item(), a2.item()))
+        save_image(
+            torch.from_numpy(np.asarray(arrowed_imgs)), self.sample_dir + "/" + f"arrows_{len(imgs)}.png"
+        )
+        return perturbed_imgs, arrowed_imgs
+
+    def __repr__(self):
+        return f"ArrowImages(sample_dir={self.sample_dir!r})"
@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+
+
+class FrameBuffer():
+    """Preallocated, growable store of CxHxW frames kept on a single device.
+
+    Frames are copied in once when they are appended and read back as one
+    contiguous tensor, so the optimization loop never re-collates them.
+    Capacity doubles when it runs out. Frames can be stored as float16 or
+    uint8 to save memory on long sequences; frames() always returns float32
+    values in [0, 1].
+    """
+
+    def __init__(self, device=torch.device("cuda"), dtype=torch.float32, capacity=16):
+        self.device = device
+        self.dtype = dtype
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+        # the objects the frames were copied from, used by sync()
+        self.sources = []
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def frame_shape(self):
+        return None if self.data is None else tuple(self.data.shape[1:])
+
+    def clear(self):
+        self.size = 0
+        self.sources = []
+
+    def _reserve(self, size, frame_shape):
+        # a cleared buffer keeps its storage for frames of the same shape, other shapes get new storage
+        if self.data is not None and size <= self.data.shape[0] and self.frame_shape == tuple(frame_shape):
+            return
+        capacity = max(self.capacity, 1)
+        while capacity < size:
+            capacity *= 2
+        data = torch.empty(capacity, *frame_shape, dtype=self.dtype, device=self.device)
+        if self.size > 0:
+            data[:self.size] = self.data[:self.size]
+        self.data = data
+        self.capacity = capacity
+
+    def _encode(self, frames):
+        frames = frames.to(self.device)
+        if self.dtype == torch.uint8:
+            return (frames * 255).round().clamp(0, 255).to(torch.uint8)
+        return frames.to(self.dtype)
+
+    def extend(self, frames):
+        if len(frames) == 0:
+            return
+        frames_t = torch.stack([torch.as_tensor(np.asarray(f)) for f in frames]).float()
+        if self.data is not None and self.size > 0 and tuple(frames_t.shape[1:]) != self.frame_shape:
+            raise ValueError(f"Frame shape {tuple(frames_t.shape[1:])} does not match buffer shape {self.frame_shape}")
+        self._reserve(self.size + len(frames_t), frames_t.shape[1:])
+        self.data[self.size:self.size + len(frames_t)] = self._encode(frames_t)
+        self.size += len(frames_t)
+        self.sources.extend(frames)
+
+    def append(self, frame):
+        self.extend([frame])
+
+    def sync(self, frames):
+        # make the buffer hold exactly `frames`, copying in only the ones it has not seen yet
+        n = min(len(frames), self.size)
+        if len(frames) < self.size or any(a is not b for a, b in zip(frames[:n], self.sources[:n])):
+            self.clear()
+            n = 0
+        self.extend(frames[n:])
+
+    def frames(self):
+        data = self.data[:self.size]
+        if self.dtype == torch.uint8:
+            return data.float() / 255.0
+        return data.float()
@@ -0,0 +1,120 @@
+import numpy as np
+import torch
+
+from .Losses import MDirE
+
+
+class FrameSampler():
+    """Picks the frames one iteration of the engine backpropagates through.
+
+    sample(compositor, rng) draws batch_size distinct frames of the
+    sequence, with probabilities from probabilities(compositor), using the
+    numpy Generator rng; sequences no longer than batch_size are used
+    whole. Frames with zero weight keep a small floor, so there are always
+    batch_size frames to draw. After the backward pass the engine calls
+    update(index, y, target, direction, loss_fxn) with the frames'
+    predictions and its loss, so samplers can track the current loss per
+    frame. reset() is called at the start of every perturb call.
+    """
+
+    name = "sampler"
+
+    def __init__(self, batch_size=32):
+        self.batch_size = batch_size
+
+    def reset(self):
+        pass
+
+    def probabilities(self, compositor):
+        raise NotImplementedError
+
+    def sample(self, compositor, rng):
+        n = len(compositor)
+        if n <= self.batch_size:
+            return np.arange(n)
+        p = np.asarray(self.probabilities(compositor), dtype=np.float64)
+        if p.sum() > 0:
+            if np.count_nonzero(p) < self.batch_size:
+                # drawing without replacement needs batch_size frames of nonzero weight
+                p = np.maximum(p, p.max() * 1e-6)
+            p = p / p.sum()
+        else:
+            p = None
+        return np.sort(rng.choice(n, size=self.batch_size, replace=False, p=p))
+
+    def update(self, index, y, target, direction, loss_fxn=None):
+        pass
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v}" for k, v in vars(self).items() if not k.startswith("_"))
+        return f"{type(self).__name__}({params})"
+
+
+class Uniform(FrameSampler):
+    """Every frame is equally likely."""
+
+    name = "uniform"
+
+    def probabilities(self, compositor):
+        return np.ones(len(compositor))
+
+
+class Recency(FrameSampler):
+    """Frame i of n is drawn with weight decay^(n - 1 - i), so the latest, closest frames dominate."""
+
+    name = "recency"
+
+    def __init__(self, batch_size=32, decay=0.98):
+        super().__init__(batch_size)
+        self.decay = decay
+
+    def probabilities(self, compositor):
+        n = len(compositor)
+        return self.decay ** np.arange(n - 1, -1, -1, dtype=np.float64)
+
+
+class BillboardArea(FrameSampler):
+    """Frames are drawn with weight proportional to the number of pixels the billboard covers in them."""
+
+    name = "billboard_area"
+
+    def probabilities(self, compositor):
+        return compositor.counts.numpy().astype(np.float64)
+
+
+class HighestLoss(FrameSampler):
+    """Frames are drawn with weight exp(loss / temperature), loss being their last seen loss.
+
+    The loss of a frame is the engine's loss_fxn on that frame alone, MDirE
+    for the run's direction when update gets none; temperature is in the
+    units of that loss. Frames that were not drawn yet get the largest loss
+    seen so far, so every frame is visited early on.
+    """
+
+    name = "highest_loss"
+
+    def __init__(self, batch_size=32, temperature=0.05):
+        super().__init__(batch_size)
+        self.temperature = temperature
+        self._errors = None
+
+    def reset(self):
+        self._errors = None
+
+    def probabilities(self, compositor):
+        n = len(compositor)
+        if self._errors is None or len(self._errors) != n:
+            self._errors = np.full(n, np.nan)
+        seen = ~np.isnan(self._errors)
+        errors = np.where(seen, self._errors, self._errors[seen].max() if seen.any() else 0.0)
+        return np.exp((errors - errors.max()) / self.temperature)
+
+    def update(self, index, y, target, direction, loss_fxn=None):
+        if self._errors is None:
+            # the whole sequence fit in one batch, nothing was sampled
+            return
+        loss_fxn = loss_fxn if loss_fxn is not None else MDirE(direction)
+        y = y.detach().reshape(-1, 1)[:len(index)]
+        target = torch.as_tensor(target).flatten()[:len(index)].to(y.device)
+        with torch.no_grad():
+            self._errors[index] = [loss_fxn(y[i:i + 1], target[i:i + 1]).item() for i in range(len(index))]
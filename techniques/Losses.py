@@ -0,0 +1,105 @@
+import torch
+import torch.nn.functional as F
+
+# name -> SteeringLoss subclass, see register_loss
+LOSSES = {}
+
+
+def register_loss(cls):
+    # class decorator; the loss can then be selected by its name wherever a loss_fxn is accepted
+    LOSSES[cls.name] = cls
+    return cls
+
+
+class SteeringLoss():
+    """Loss between the predicted steering angles and the steering target.
+
+    The engines minimize loss(y, target), where y holds the Nx1 predicted
+    angles and target the N target angles. Directional losses are negated
+    for direction "right", so minimizing always pushes towards the target.
+    Losses that weight the frames build their weights once per sequence
+    length and device in make_weights and reuse them from then on.
+    """
+
+    name = "loss"
+
+    def __init__(self, direction="left"):
+        self.direction = direction
+        self._weights = {}
+
+    def __call__(self, y, target):
+        assert len(target.shape)
+        assert y.shape[0] == target.shape[0]
+        assert y.shape[1] == 1
+        return self.compute(y.flatten(), target)
+
+    def weights(self, n, device):
+        key = (n, str(device))
+        if key not in self._weights:
+            self._weights[key] = self.make_weights(n).to(device)
+        return self._weights[key]
+
+    def make_weights(self, n):
+        raise NotImplementedError
+
+    def compute(self, y, target):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(direction={self.direction!r})"
+
+
+@register_loss
+class MDirE(SteeringLoss):
+    """Mean directional error, the usual loss: mean(y - target), negated for "right"."""
+
+    name = "MDirE"
+
+    def compute(self, y, target):
+        if self.direction == "left":
+            return (y - target).mean()
+        return -(y - target).mean()
+
+
+@register_loss
+class MSE(SteeringLoss):
+    """Mean squared error, used by the multi-objective scripts to steer towards per-frame goal angles."""
+
+    name = "MSE"
+
+    def compute(self, y, target):
+        return F.mse_loss(y, target)
+
+
+@register_loss
+class MAbsE(SteeringLoss):
+
+    name = "MAbsE"
+
+    def compute(self, y, target):
+        return abs(y - target).mean()
+
+
+@register_loss
+class Inv23(SteeringLoss):
+    """Directional error weighted by 1 / i^(1/10), so the early (small, distant) billboard frames count more."""
+
+    name = "inv23"
+
+    def make_weights(self, n):
+        return 1 / torch.pow(torch.Tensor([i for i in range(1, n + 1)]), 1/10)
+
+    def compute(self, y, target):
+        decay_factors = self.weights(y.shape[0], y.device)
+        if self.direction == "left":
+            return (decay_factors * (y - target)).mean()
+        return -(decay_factors * (y - target)).mean()
+
+
+def make_loss(loss_fxn, direction):
+    # loss_fxn is one of the names in LOSSES or a SteeringLoss, which is returned as-is
+    if isinstance(loss_fxn, SteeringLoss):
+        return loss_fxn
+    if loss_fxn not in LOSSES:
+        raise ValueError(f"Unknown loss {loss_fxn!r}, expected one of {sorted(LOSSES)}")
+    return LOSSES[loss_fxn](direction)
@@ -0,0 +1,151 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class Parameterization():
+    """Maps the optimized parameters to the billboard texture.
+
+    The engines optimize encode(texture) instead of the 1x3xSxS texture
+    itself and composite decode(param, S) into the frames. Parameters live
+    in [0, 1] like the texels, so every StepRule (and its clamping) works
+    on them unchanged. decode(param, S, final=True) gives the texture that
+    is returned and printed.
+    """
+
+    name = "parameterization"
+
+    def encode(self, texture):
+        raise NotImplementedError
+
+    def decode(self, param, size, final=False):
+        raise NotImplementedError
+
+    def num_params(self, size):
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v}" for k, v in vars(self).items() if not k.startswith("_"))
+        return f"{type(self).__name__}({params})"
+
+
+class Pixels(Parameterization):
+    """One parameter per texel, what the engines optimize without a parameterization."""
+
+    name = "pixels"
+
+    def encode(self, texture):
+        return texture
+
+    def decode(self, param, size, final=False):
+        return param
+
+    def num_params(self, size):
+        return 3 * size * size
+
+
+class DCT(Parameterization):
+    """The lowest coefficients x coefficients frequencies of an orthonormal 2D DCT per channel.
+
+    A parameter p stands for the coefficient (p - 0.5) * S of the texture
+    minus 0.5, so the all-0.5 parameters decode to the gray billboard and
+    a step of the DC parameter moves every texel by about the step size.
+    """
+
+    name = "dct"
+
+    def __init__(self, coefficients=4):
+        self.coefficients = coefficients
+        self._bases = {}
+
+    def basis(self, size, device):
+        # the first `coefficients` rows of the SxS DCT-II matrix
+        key = (size, str(device))
+        if key not in self._bases:
+            k = torch.arange(min(self.coefficients, size), dtype=torch.float)[:, None]
+            i = torch.arange(size, dtype=torch.float)[None, :]
+            basis = math.sqrt(2 / size) * torch.cos(math.pi * (2 * i + 1) * k / (2 * size))
+            basis[0] /= math.sqrt(2)
+            self._bases[key] = basis.to(device)
+        return self._bases[key]
+
+    def encode(self, texture):
+        size = texture.shape[-1]
+        basis = self.basis(size, texture.device)
+        coefficients = basis @ (texture - 0.5) @ basis.T
+        return torch.clamp(coefficients / size + 0.5, 0, 1)
+
+    def decode(self, param, size, final=False):
+        basis = self.basis(size, param.device)
+        return torch.clamp(basis.T @ ((param - 0.5) * size) @ basis + 0.5, 0, 1)
+
+    def num_params(self, size):
+        return 3 * min(self.coefficients, size) ** 2
+
+
+class ControlGrid(Parameterization):
+    """A points x points grid of control colors, bicubically interpolated up to the billboard size."""
+
+    name = "control_grid"
+
+    def __init__(self, points=4):
+        self.points = points
+
+    def encode(self, texture):
+        return F.interpolate(texture, size=(self.points, self.points), mode="area")
+
+    def decode(self, param, size, final=False):
+        return torch.clamp(F.interpolate(param, size=(size, size), mode="bicubic", align_corners=True), 0, 1)
+
+    def num_params(self, size):
+        return 3 * self.points ** 2
+
+
+class Palette(Parameterization):
+    """Every texel picks one of `colors` optimized colors, so the billboard prints with a fixed set of inks.
+
+    The parameters are the colors x 3 palette followed by one score per
+    color and texel; during optimization a texel is the softmax of its
+    scores / temperature blend of the palette, the final texture snaps
+    each texel to its best scoring color. The palette starts as evenly
+    spaced grays and the scores from the distance of each texel to them.
+    """
+
+    name = "palette"
+
+    def __init__(self, colors=8, temperature=0.1):
+        self.colors = colors
+        self.temperature = temperature
+
+    def encode(self, texture):
+        grays = torch.linspace(0, 1, self.colors, device=texture.device)
+        palette = grays[:, None].expand(self.colors, 3)
+        distance = (texture.mean(dim=1) - grays[:, None, None]).abs()
+        scores = torch.clamp(1 - distance, 0, 1)
+        return torch.cat((palette.flatten(), scores.flatten()))[None]
+
+    def decode(self, param, size, final=False):
+        palette = param[0, :3 * self.colors].view(self.colors, 3)
+        scores = param[0, 3 * self.colors:].view(self.colors, size, size)
+        if final:
+            weights = F.one_hot(scores.argmax(dim=0), self.colors).permute(2, 0, 1).to(param.dtype)
+        else:
+            weights = torch.softmax(scores / self.temperature, dim=0)
+        return torch.einsum("kc,khw->chw", palette, weights)[None]
+
+    def num_params(self, size):
+        return 3 * self.colors + self.colors * size * size
+
+
+PARAMETERIZATIONS = {cls.name: cls for cls in (Pixels, DCT, ControlGrid, Palette)}
+
+
+def make_parameterization(parameterization):
+    # parameterization is one of the names in PARAMETERIZATIONS (with its default settings), a Parameterization
+    # or None for the raw texels
+    if parameterization is None or isinstance(parameterization, Parameterization):
+        return parameterization
+    if parameterization not in PARAMETERIZATIONS:
+        raise ValueError(f"Unknown parameterization {parameterization!r}, expected one of {sorted(PARAMETERIZATIONS)}")
+    return PARAMETERIZATIONS[parameterization]()
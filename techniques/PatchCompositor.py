@@ -0,0 +1,109 @@
+import copy
+
+import torch
+
+
+class _Composite(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, frames, texture, dst, src):
+        # frames: NxCxHxW, texture: KxCxhxw, dst/src: flat frame/texel indices of the patch pixels
+        k = texture.shape[0]
+        frame_numel, texture_numel = frames[0].numel() * len(frames), texture[0].numel()
+        offsets = torch.arange(k, device=dst.device)[:, None]
+        dst = (dst[None] + offsets * frame_numel).flatten()
+        src = (src[None] + offsets * texture_numel).flatten()
+        out = frames.reshape(1, -1).repeat(k, 1).flatten()
+        out[dst] = texture.reshape(-1)[src]
+        ctx.save_for_backward(dst, src)
+        ctx.shapes = frames.shape, texture.shape
+        return out.view(k * frames.shape[0], *frames.shape[1:])
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        dst, src = ctx.saved_tensors
+        frames_shape, texture_shape = ctx.shapes
+        grad_out = grad_out.reshape(-1)
+        grad_frames = grad_texture = None
+        if ctx.needs_input_grad[1]:
+            # only the texels that land in a frame receive gradient
+            grad_texture = torch.zeros(texture_shape.numel(), dtype=grad_out.dtype, device=grad_out.device)
+            grad_texture.index_add_(0, src, grad_out[dst])
+            grad_texture = grad_texture.view(texture_shape)
+        if ctx.needs_input_grad[0]:
+            grad_frames = grad_out.clone()
+            grad_frames[dst] = 0
+            grad_frames = grad_frames.view(texture_shape[0], *frames_shape).sum(0)
+        return grad_frames, grad_texture, None, None
+
+
+class PatchCompositor():
+    """Pastes a billboard texture into a sequence of frames with a single index_put.
+
+    Built from, per frame, the flat indices of the pixels covered by the patch
+    and the texel each of them samples (see PatchGeometryCache.compositor).
+    Compositing and its backward pass only touch those pixels instead of
+    warping and blending full frames. The result matches
+    frames * (1 - mask) + warp_perspective(texture, mode="nearest") * mask.
+    """
+
+    def __init__(self, pixels, texels, frame_shape, texture_shape, device=torch.device("cuda")):
+        # pixels[n], texels[n]: flat HxW pixel indices in frame n and the flat hxw texel they show
+        c, h, w = frame_shape
+        self.frame_shape = tuple(frame_shape)
+        self.texture_shape = tuple(texture_shape)
+        self.device = device
+        self.num_frames = len(pixels)
+        # [x0, y0, x1, y1) box around the patch pixels of each frame, empty for frames the patch misses
+        self.bboxes = torch.tensor([
+            [int((p % w).min()), int((p // w).min()), int((p % w).max()) + 1, int((p // w).max()) + 1]
+            if len(p) > 0 else [0, 0, 0, 0] for p in pixels
+        ], dtype=torch.long)
+        # number of patch pixels per frame, and the patch pixels / texels of all frames back to back
+        self.counts = torch.tensor([len(p) for p in pixels], dtype=torch.long)
+        self.pixels = torch.cat([torch.as_tensor(p, dtype=torch.long).cpu() for p in pixels]).to(device)
+        self.texels = torch.cat([torch.as_tensor(t, dtype=torch.long).cpu() for t in texels]).to(device)
+        self.index()
+
+    def index(self):
+        # flat frame / texture indices of every channel of every patch pixel
+        c, h, w = self.frame_shape
+        frame_ids = torch.repeat_interleave(torch.arange(self.num_frames, device=self.device), self.counts.to(self.device))
+        channels = torch.arange(c, device=self.device)[:, None]
+        self.dst = ((frame_ids[None] * c + channels) * (h * w) + self.pixels[None]).flatten()
+        self.src = (channels * (self.texture_shape[1] * self.texture_shape[2]) + self.texels[None]).flatten()
+
+    def __len__(self):
+        return self.num_frames
+
+    def subset(self, index):
+        """Returns a compositor for the frames at index (a 1D LongTensor), in that order."""
+        index = index.cpu()
+        counts = self.counts[index]
+        starts = torch.cumsum(self.counts, 0) - self.counts
+        # positions of the selected frames' pixels in self.pixels / self.texels
+        offsets = torch.repeat_interleave(starts[index] - (torch.cumsum(counts, 0) - counts), counts)
+        positions = (offsets + torch.arange(int(counts.sum()))).to(self.device)
+        compositor = copy.copy(self)
+        compositor.num_frames = len(index)
+        compositor.bboxes = self.bboxes[index]
+        compositor.counts = counts
+        compositor.pixels = self.pixels[positions]
+        compositor.texels = self.texels[positions]
+        compositor.index()
+        return compositor
+
+    def bbox_masks(self):
+        """Returns Nx1xHxW masks that are 1 inside each frame's patch bounding box."""
+        masks = torch.zeros(self.num_frames, 1, *self.frame_shape[1:], device=self.device)
+        for mask, (x0, y0, x1, y1) in zip(masks, self.bboxes.tolist()):
+            mask[:, y0:y1, x0:x1] = 1
+        return masks
+
+    def __call__(self, frames, texture):
+        """Returns the frames with texture pasted in; a KxCxhxw texture gives K*N frames, texture-major."""
+        if tuple(frames.shape[1:]) != self.frame_shape or len(frames) != self.num_frames:
+            raise ValueError(f"Expected {self.num_frames} frames of shape {self.frame_shape}, got {tuple(frames.shape)}")
+        if tuple(texture.shape[1:]) != self.texture_shape:
+            raise ValueError(f"Expected a texture of shape {self.texture_shape}, got {tuple(texture.shape[1:])}")
+        return _Composite.apply(frames, texture, self.dst, self.src)
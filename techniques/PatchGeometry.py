@@ -0,0 +1,116 @@
+import kornia
+import numpy as np
+import torch
+
+from .PatchCompositor import PatchCompositor
+
+class PatchGeometryCache():
+    """Per-frame cache of the billboard geometry.
+
+    Entries are keyed by frame id, corner coordinates, billboard size and
+    frame size, and hold the homography from the billboard texture to the
+    frame together with the warped binary mask, its complement and the
+    sparse pixel -> texel map used by PatchCompositor. They depend only on
+    the patch corners, so they are computed once and reused across
+    iterations and across successive SDBB timesteps.
+    """
+
+    def __init__(self, device=torch.device("cuda"), max_entries=4096):
+        self.device = device
+        self.max_entries = max_entries
+        self.entries = {}
+        # the last stacked lookup, returned as-is when the same frames are requested again
+        self.last_keys = None
+        self.last_batch = None
+        self.last_compositor = None
+        # the last compositor for several billboards, see atlas_compositor
+        self.last_atlas = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = {}
+        self.last_keys = None
+        self.last_batch = None
+        self.last_compositor = None
+        self.last_atlas = None
+
+    @staticmethod
+    def key(patch, bb_size, dsize):
+        # patch is one row of img_patches: [frame_id, x0, y0, x1, y1, x2, y2, x3, y3]
+        return int(patch[0]), tuple(float(c) for c in patch[1:]), bb_size, tuple(dsize)
+
+    def _compute(self, patches, bb_size, dsize):
+        h = w = bb_size
+        patch_coords = torch.from_numpy(np.asarray(patches)[:, 1:].reshape((-1, 4, 2))).float()
+        src_coords = torch.tensor(
+            [[0.0, 0.0], [w - 1.0, 0.0], [0.0, h - 1.0], [w - 1.0, h - 1.0]]
+        ).repeat(len(patch_coords), 1, 1)
+        transforms = kornia.geometry.transform.get_perspective_transform(src_coords, patch_coords).to(self.device)
+        # warp texel ids (1-based, 0 is outside the patch) with the same sampling as the perturbation
+        texel_ids = torch.arange(1, h * w + 1, dtype=torch.float32, device=self.device).view(1, 1, h, w)
+        texel_maps = kornia.geometry.transform.warp_perspective(
+            texel_ids.expand(len(patch_coords), 1, h, w), transforms, dsize=tuple(dsize),
+            mode="nearest",
+            align_corners=True
+        ).round().long().flatten(1) - 1
+        masks = (texel_maps >= 0).float().view(len(patch_coords), 1, *dsize)
+        pixels = [torch.nonzero(texel_map >= 0).flatten() for texel_map in texel_maps]
+        texels = [texel_map[p] for texel_map, p in zip(texel_maps, pixels)]
+        return transforms, masks, pixels, texels
+
+    def lookup(self, img_patches, bb_size, dsize):
+        """Returns (homographies Nx3x3, masks Nx1xHxW, inverse masks Nx1xHxW) for the frames in img_patches."""
+        keys = [self.key(patch, bb_size, dsize) for patch in img_patches]
+        if keys == self.last_keys:
+            return self.last_batch
+        missing = [i for i, k in enumerate(keys) if k not in self.entries]
+        if missing:
+            transforms, masks, pixels, texels = self._compute([img_patches[i] for i in missing], bb_size, dsize)
+            for j, i in enumerate(missing):
+                self.entries[keys[i]] = (transforms[j], masks[j], 1 - masks[j], pixels[j], texels[j])
+        entries = [self.entries[k] for k in keys]
+        while len(self.entries) > max(self.max_entries, len(keys)):
+            del self.entries[next(iter(self.entries))]
+        batch = tuple(torch.stack(t) for t in list(zip(*entries))[:3])
+        self.last_keys, self.last_batch, self.last_compositor = keys, batch, None
+        return batch
+
+    def compositor(self, img_patches, bb_size, dsize, channels=3):
+        """Returns a PatchCompositor that pastes a channels x bb_size x bb_size texture into the frames in img_patches."""
+        self.lookup(img_patches, bb_size, dsize)
+        if self.last_compositor is None or self.last_compositor.frame_shape[0] != channels:
+            entries = [self.entries[k] for k in self.last_keys]
+            self.last_compositor = PatchCompositor(
+                [e[3] for e in entries], [e[4] for e in entries],
+                (channels, *dsize), (channels, bb_size, bb_size), device=self.device
+            )
+        return self.last_compositor
+
+    def atlas_compositor(self, billboard_patches, bb_size, dsize, channels=3):
+        """Returns a PatchCompositor that pastes B billboards into the frames at once.
+
+        billboard_patches holds one img_patches array per billboard, with a
+        row for every frame. The B channels x bb_size x bb_size textures are
+        stacked top to bottom into one channels x (B * bb_size) x bb_size
+        atlas, which is what the compositor takes. Billboards are assumed not
+        to overlap in the frames.
+        """
+        keys = [[self.key(patch, bb_size, dsize) for patch in patches] for patches in billboard_patches]
+        if self.last_atlas is not None and self.last_atlas[0] == (keys, channels):
+            return self.last_atlas[1]
+        billboard_entries = []
+        for patches, billboard_keys in zip(billboard_patches, keys):
+            # read right away, the next lookup may evict them
+            self.lookup(patches, bb_size, dsize)
+            billboard_entries.append([self.entries[k] for k in billboard_keys])
+        texels_per_billboard = bb_size * bb_size
+        pixels, texels = [], []
+        for entries in zip(*billboard_entries):
+            pixels.append(torch.cat([e[3] for e in entries]))
+            texels.append(torch.cat([e[4] + b * texels_per_billboard for b, e in enumerate(entries)]))
+        compositor = PatchCompositor(pixels, texels, (channels, *dsize),
+                                     (channels, len(billboard_patches) * bb_size, bb_size), device=self.device)
+        self.last_atlas = ((keys, channels), compositor)
+        return compositor
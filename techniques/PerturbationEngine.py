@@ -0,0 +1,421 @@
+import itertools
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .ChunkedBackward import peak_rss, reset_peak_rss
+from .DeviceResidency import DeviceResidency
+from .Evaluations import SteeringMAE, draw_arrows
+from .FrameBuffer import FrameBuffer
+from .Losses import MDirE
+from .Parameterizations import Pixels, make_parameterization
+from .PatchGeometry import PatchGeometryCache
+from .PredictionCache import PredictionCache
+from .StepRules import SignSGD
+from .StoppingCriteria import LossPlateau, first_fired, reset_all
+
+
+class PerturbationEngine():
+    """Optimizes a billboard texture over an image sequence.
+
+    Every iteration composites the texture into the frames, adds sensor
+    noise, optionally diversifies the frames, runs the model and steps the
+    texture along the gradient of the loss. The loss (see Losses), the
+    diversification (see Diversifications) and the final evaluation (see
+    Evaluations) are pluggable; DeepBillboard, SuperDeepBillboard and
+    GradientAscent are this loop with their own strategies.
+    """
+
+    def __init__(self, model, seqpath, direction, loss=None, diversification=None, evaluation=None,
+                 init_value=0.5, verbose=False, frame_dtype=torch.float32, sample_dir=None, seed=None,
+                 predictions=None, residency=None):
+        self.model = model
+        self.seqpath = seqpath
+        self.direction = direction
+        self.loss = loss if loss is not None else MDirE(direction)
+        self.diversification = diversification
+        self.evaluation = evaluation if evaluation is not None else SteeringMAE()
+        # value of every texel of a fresh billboard
+        self.init_value = init_value
+        # print the loss every iteration instead of once at the end
+        self.verbose = verbose
+        # device-resident copy of the image sequence, see FrameBuffer
+        self.frames = None
+        self.frame_dtype = frame_dtype
+        self.geometry = None
+        # unperturbed predictions of the frames, pass a shared PredictionCache to reuse the caller's
+        self.predictions = predictions
+        # keeps the model on the optimization device between calls, pass a shared DeviceResidency for a whole run
+        self.residency = residency
+        # perturbation from the previous call, used to warm-start the next one
+        self.perturbation = None
+        # iterations completed, why the last call stopped, how long it took and the seed it used
+        self.stats = {}
+        # every call draws its noise and diversification from streams seeded from this sequence
+        self.seeds = np.random.SeedSequence(seed)
+        self.sample_dir = os.getcwd() + "/sampledir" if sample_dir is None else sample_dir
+        if not os.path.exists(self.sample_dir):
+            os.mkdir(self.sample_dir)
+
+    def stripleftchars(self, s):
+        for i in range(len(s)):
+            if s[i].isnumeric():
+                return s[i:]
+        return -1
+
+    def draw_arrows(self, img, angle1, angle2=None):
+        return draw_arrows(img, angle1, angle2)
+
+    def load_frames(self, img_arr, device):
+        # copy new frames to the device once; the loop reads them back as one tensor
+        if self.frames is None or self.frames.device != device:
+            self.frames = FrameBuffer(device=device, dtype=self.frame_dtype)
+        self.frames.sync(img_arr)
+        return self.frames.frames()
+
+    def load_geometry(self, img_patches, bb_size, shape, device):
+        # the patch pixels only depend on the patch corners, so they are cached per frame
+        if self.geometry is None or self.geometry.device != device:
+            self.geometry = PatchGeometryCache(device=device)
+        if self.billboard_count(img_patches) is not None:
+            return self.geometry.atlas_compositor(img_patches, bb_size, shape)
+        return self.geometry.compositor(img_patches, bb_size, shape)
+
+    @staticmethod
+    def billboard_count(img_patches):
+        # img_patches is one Nx9 array of patch rows, or a BxNx9 stack of them for B billboards per frame, which are
+        # optimized jointly as the rows of one atlas texture (see PatchGeometryCache.atlas_compositor); None for one
+        patches = np.asarray(img_patches)
+        return patches.shape[0] if patches.ndim == 3 else None
+
+    def texture_shape(self, img_patches, bb_size):
+        count = self.billboard_count(img_patches)
+        return (3, bb_size, bb_size) if count is None else (3, count * bb_size, bb_size)
+
+    def split_billboards(self, bb, img_patches):
+        # the HxWx3 uint8 atlas of several billboards as a list of one HxWx3 billboard each
+        count = self.billboard_count(img_patches)
+        return bb if count is None else np.split(bb, count)
+
+    def pin(self, model, device):
+        if self.residency is None or self.residency.device != device:
+            self.residency = DeviceResidency(device)
+        return self.residency.pin(model)
+
+    def clean_predictions(self, model, img_arr, clean_imgs, device):
+        if self.predictions is None or self.predictions.model is not model or self.predictions.device != device:
+            self.predictions = PredictionCache(model, device=device)
+        return self.predictions.sync(img_arr, clean_imgs)
+
+    def initial_perturbation(self, pert_shape, device):
+        return (torch.ones(1, *pert_shape) * self.init_value).float().to(device)
+
+    def next_seed(self):
+        return int(self.seeds.spawn(1)[0].generate_state(1)[0])
+
+    def generators(self, seed, device):
+        # the device-side noise stream and the host-side diversification stream of one run or candidate
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        return generator, np.random.default_rng(seed)
+
+    def perturb(self, img_arr, img_patches, model, target, bb_size=5, iterations=400, noise_level=25,
+                device=torch.device("cuda"), loss=None, diversification=None, evaluation=None,
+                warm_start=False, refine_iterations=25, refine_window=5, refine_tol=1e-4,
+                incremental_inference=False, time_budget=None, stopping=None, step_rule=None, seed=None, init=None,
+                parameterization=None, sampler=None, chunker=None):
+        # target: steering angle per frame that the loss pulls the predictions towards
+        # loss, diversification, evaluation: override the engine's strategies for this call
+        # warm_start: continue from the perturbation found by the previous call instead of starting from a fresh
+        # billboard, running at most refine_iterations and stopping early once the loss stops changing
+        # incremental_inference: only recompute the activations around the billboard, see IncrementalForward in
+        # DAVE2pytorch; the noise is then only added inside the billboard's bounding box
+        # time_budget: wall-clock seconds for the whole call, after which the perturbation with the lowest loss seen
+        # so far is returned; self.stats reports how many iterations were completed
+        # stopping: list of StoppingCriteria that end the loop early; self.stats names the one that fired
+        # step_rule: update rule from StepRules, defaults to the sign step of 1/100
+        # seed: seeds the noise and the diversification, a fresh one is drawn from self.seeds when None; the call's
+        # seed is reported in self.stats and reproduces its billboard exactly
+        # init: 1x3xbb_sizexbb_size texture to start from instead of a fresh billboard, see perturb_multiscale
+        # parameterization: what the step rule optimizes instead of the texels, e.g. a truncated DCT, see
+        # Parameterizations; a name from PARAMETERIZATIONS or a Parameterization
+        # sampler: a FrameSampler that picks the frames each iteration runs on, so an iteration costs O(batch_size)
+        # instead of O(len(img_arr)); y is then predicted on the whole sequence with the final, noise-free billboard
+        # chunker: a ChunkedBackward that bounds the memory of the backward pass by running the model on a chunk of
+        # frames at a time; with a chunker self.stats reports the peak RSS during the call, with "peak_rss_scope"
+        # "process" where the OS only gives the peak of the whole process lifetime (and on CUDA always the peak
+        # device memory)
+        # img_patches: Nx9 patch rows, or a BxNx9 stack for B billboards per frame that are optimized jointly
+        # Returns (bb, y, *evaluation results), bb being the HxWx3 uint8 billboard (a list of B for B billboards).
+        start = time.perf_counter()
+        loss_fxn = loss if loss is not None else self.loss
+        diversification = diversification if diversification is not None else self.diversification
+        evaluation = evaluation if evaluation is not None else self.evaluation
+        seed = seed if seed is not None else self.next_seed()
+        generator, rng = self.generators(seed, device)
+        # resetting the peak RSS clears process-wide counters, so only calls that bound their memory measure it
+        rss_scope = None if chunker is None else "call" if reset_peak_rss() else "process"
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+
+        pert_shape = self.texture_shape(img_patches, bb_size)
+        if self.billboard_count(img_patches) is not None and make_parameterization(parameterization) is not None:
+            raise ValueError("several billboards are optimized as one atlas of texels, they cannot be parameterized")
+        model = self.pin(model, device)
+        target = target.to(device)
+        clean_imgs = self.load_frames(img_arr, device)
+        compositor = self.load_geometry(img_patches, bb_size, clean_imgs.shape[2:], device)
+        forward, noise_mask = model, None
+        if incremental_inference:
+            if sampler is not None or chunker is not None:
+                raise ValueError("incremental_inference caches the activations of every frame, it cannot be combined with a sampler or chunker")
+            if diversification is not None:
+                raise ValueError("incremental_inference only sees the billboard region, it cannot be combined with input_divers")
+            forward = model.incremental_forward(clean_imgs, compositor.bboxes)
+            noise_mask = compositor.bbox_masks()
+
+        refining = warm_start and self.perturbation is not None and self.perturbation.shape[1:] == pert_shape
+        if refining:
+            perturbation = self.perturbation.to(device)
+            iterations = refine_iterations
+        elif init is not None:
+            perturbation = init.detach().to(device)
+        else:
+            perturbation = self.initial_perturbation(pert_shape, device)
+        stopping = list(stopping or [])
+        if refining:
+            stopping.insert(0, LossPlateau(window=refine_window, tol=refine_tol))
+        reset_all(stopping)
+        best_loss, best_perturbation = None, perturbation
+        stopped_by = "iterations"
+        step_rule = step_rule if step_rule is not None else SignSGD(step_size=0.01)
+        step_rule.reset()
+        parameterization = make_parameterization(parameterization) or Pixels()
+        param = step_rule.init(parameterization.encode(perturbation))
+        noise = None
+        frames, frame_target, frame_compositor = clean_imgs, target, compositor
+        if sampler is not None:
+            sampler.reset()
+        for i in range(iterations):
+            param = param.detach()
+            param.requires_grad = True
+            perturbation = parameterization.decode(step_rule.texture(param), bb_size)
+            if perturbation is not param:
+                perturbation.retain_grad()
+
+            if sampler is not None:
+                index = sampler.sample(compositor, rng)
+                frame_index = torch.as_tensor(index, device=device)
+                frames, frame_target = clean_imgs[frame_index], target[frame_index]
+                frame_compositor = compositor.subset(frame_index)
+            # only the patch pixels are written, and only the patch texels receive gradient
+            imgs = frame_compositor(frames, perturbation)
+            steering_target = frame_target
+            if diversification is not None and diversification.before_noise:
+                imgs, steering_target = diversification(imgs, frame_target, rng)
+            # drawn on the device into the same buffer every iteration
+            if noise is None or noise.shape != imgs.shape:
+                noise = torch.empty(imgs.shape, device=device)
+            noise.normal_(0, 1 / noise_level, generator=generator)
+            if noise_mask is not None:
+                noise.mul_(noise_mask)
+            imgs = torch.clamp(imgs + noise, 0, 1)
+            if diversification is not None and not diversification.before_noise:
+                imgs, steering_target = diversification(imgs, frame_target, rng)
+            if chunker is None:
+                y = forward(imgs)
+                loss = loss_fxn(y, steering_target)
+                loss.backward()
+            else:
+                y, loss = chunker.backward(model, imgs, loss_fxn, steering_target)
+            if time_budget is not None and (best_loss is None or loss.item() < best_loss):
+                best_loss, best_perturbation = loss.item(), perturbation.detach()
+            if self.verbose:
+                print(
+                    f"[iteration {i:5d}/{iterations}] loss={loss.item():2.5f} max(angle)={y.max().item():2.5f} min(angle)={y.min().item():2.5f} mean(angle)={y.mean().item():2.5f} median(angle)={torch.median(y).item():2.5f}"
+                )
+            if sampler is not None:
+                sampler.update(index, y, frame_target, self.direction, loss_fxn)
+            fired = first_fired(stopping, loss, y, steering_target, perturbation, self.direction)
+            if fired is not None:
+                stopped_by = fired
+                break
+
+            param = step_rule.step(param.detach(), param.grad, i)
+            model.zero_grad()
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                stopped_by = "deadline"
+                break
+        with torch.no_grad():
+            perturbation = parameterization.decode(step_rule.texture(param.detach()), bb_size, final=True)
+        final_loss = loss.item()
+        if time_budget is not None:
+            # report the loss of the perturbation that is returned, not that of the last iteration
+            perturbation, final_loss = best_perturbation, best_loss
+        self.perturbation = perturbation.detach()
+        if not self.verbose:
+            print(
+                f"[iteration {i:5d}/{iterations}] loss={loss.item():2.5f} max(angle)={y.max().item():2.5f} min(angle)={y.min().item():2.5f} mean(angle)={y.mean().item():2.5f} median(angle)={torch.median(y).item():2.5f}"
+            )
+
+        # evaluated on the device; only the billboard, the predictions and the scores are copied out
+        with torch.no_grad():
+            if sampler is not None:
+                imgs = compositor(clean_imgs, perturbation)
+            y = model(imgs)
+            y = y.cpu().numpy().reshape((y.shape[0]))
+            bb = self.split_billboards(self.residency.billboard(perturbation), img_patches)
+            perturbed_imgs = compositor(clean_imgs, perturbation.detach())
+            orig_angles = self.clean_predictions(model, img_arr, clean_imgs, device)
+            results = evaluation(model, clean_imgs, perturbed_imgs, device, orig_angles=orig_angles)
+        self.stats = {"iterations": i + 1, "stopped_by": stopped_by, "time": time.perf_counter() - start, "seed": seed,
+                      "loss": final_loss}
+        if rss_scope is not None:
+            self.stats.update(peak_rss=peak_rss(), peak_rss_scope=rss_scope)
+        if device.type == "cuda":
+            self.stats["peak_device_memory"] = torch.cuda.max_memory_allocated(device)
+        return (bb, y, *results)
+
+    def perturb_multiscale(self, img_arr, img_patches, model, target, bb_size=5, levels=(2, 4),
+                           level_iterations=None, iterations=400, upsample="bilinear", warm_start=False,
+                           time_budget=None, stopping=None, seed=None, **kwargs):
+        # coarse-to-fine: optimizes a levels[0]xlevels[0] billboard for level_iterations[0] iterations, upsamples it
+        # into the next level as its starting texture and so on, and finishes with iterations at bb_size
+        # level_iterations: None gives every coarse level an eighth of iterations, 50 each for the default 400
+        # upsample: interpolation mode of F.interpolate between levels
+        # stopping only applies at bb_size, the coarse levels always run their budget; time_budget covers all levels
+        # a warm start at bb_size skips the coarse levels
+        # the other arguments are passed to perturb; self.stats sums the levels and lists them under "levels"
+        if level_iterations is None:
+            level_iterations = [max(1, iterations // 8)] * len(levels)
+        if len(levels) != len(level_iterations):
+            raise ValueError(f"got {len(levels)} levels but {len(level_iterations)} level_iterations")
+        if any(size >= bb_size for size in levels):
+            raise ValueError(f"levels {tuple(levels)} have to be smaller than bb_size={bb_size}")
+        if self.billboard_count(img_patches) is not None:
+            raise ValueError("perturb_multiscale optimizes a single billboard")
+        start = time.perf_counter()
+        if warm_start and self.perturbation is not None and self.perturbation.shape[1:] == (3, bb_size, bb_size):
+            levels, level_iterations = (), ()
+        seed = seed if seed is not None else self.next_seed()
+        level_seeds = [int(s) for s in np.random.SeedSequence(seed).generate_state(len(levels) + 1)]
+        schedule = list(zip(levels, level_iterations)) + [(bb_size, iterations)]
+        texture, level_stats = None, []
+        for level, ((size, its), level_seed) in enumerate(zip(schedule, level_seeds)):
+            final = level == len(schedule) - 1
+            if texture is not None:
+                texture = F.interpolate(texture, size=(size, size), mode=upsample,
+                                        align_corners=None if upsample == "nearest" else False).clamp(0, 1)
+            remaining = None if time_budget is None else max(time_budget - (time.perf_counter() - start), 0)
+            results = self.perturb(img_arr, img_patches, model, target, bb_size=size, iterations=its,
+                                   warm_start=warm_start and final, time_budget=remaining,
+                                   stopping=stopping if final else None, seed=level_seed, init=texture, **kwargs)
+            texture = self.perturbation
+            level_stats.append(dict(self.stats, bb_size=size))
+        self.stats = {"iterations": sum(s["iterations"] for s in level_stats), "stopped_by": self.stats["stopped_by"],
+                      "time": time.perf_counter() - start, "seed": seed, "loss": self.stats["loss"],
+                      "levels": level_stats}
+        return results
+
+    def perturb_population(self, img_arr, img_patches, model, target,
+                           bb_size=5, iterations=400, seeds=(None,), noise_levels=(25,), step_sizes=(0.01,),
+                           device=torch.device("cuda"), loss=None, diversification=None, warm_start=False,
+                           incremental_inference=False, time_budget=None, seed=None):
+        # optimizes one candidate billboard per combination of seed, noise level and step size in a single run by
+        # folding the candidates into the batch dimension; seed None starts from a fresh billboard (or from the
+        # previous perturbation when warm_start is set), other seeds from uniform noise.
+        # Returns the candidate with the lowest noise-free loss and a dict with every candidate's loss curve.
+        # time_budget: wall-clock seconds for the whole call, after which the candidates are compared as they are
+        # seed: seeds the run, every candidate gets its own noise and diversification streams derived from it
+        start = time.perf_counter()
+        loss_fxn = loss if loss is not None else self.loss
+        diversification = diversification if diversification is not None else self.diversification
+        if diversification is not None and diversification.before_noise:
+            raise ValueError("perturb_population adds per-candidate noise first, it cannot diversify before the noise")
+        seed = seed if seed is not None else self.next_seed()
+        pert_shape = self.texture_shape(img_patches, bb_size)
+        model = self.pin(model, device)
+        target = target.to(device)
+        clean_imgs = self.load_frames(img_arr, device)
+        compositor = self.load_geometry(img_patches, bb_size, clean_imgs.shape[2:], device)
+        candidates = [{"seed": seed, "noise_level": nl, "step_size": step}
+                      for seed, nl, step in itertools.product(seeds, noise_levels, step_sizes)]
+        k, n = len(candidates), len(clean_imgs)
+        candidate_seeds = [int(s) for s in np.random.SeedSequence(seed).generate_state(k)]
+        streams = [self.generators(s, device) for s in candidate_seeds]
+        forward, noise_mask = model, None
+        if incremental_inference:
+            if diversification is not None:
+                raise ValueError("incremental_inference only sees the billboard region, it cannot be combined with input_divers")
+            forward = model.incremental_forward(clean_imgs, compositor.bboxes)
+            noise_mask = compositor.bbox_masks().repeat(k, 1, 1, 1)
+
+        perturbation = []
+        for candidate in candidates:
+            if candidate["seed"] is not None:
+                generator = torch.Generator().manual_seed(candidate["seed"])
+                perturbation.append(torch.rand(1, *pert_shape, generator=generator).to(device))
+            elif warm_start and self.perturbation is not None and self.perturbation.shape[1:] == pert_shape:
+                perturbation.append(self.perturbation.to(device))
+            else:
+                perturbation.append(self.initial_perturbation(pert_shape, device))
+        perturbation = torch.cat(perturbation)
+        # frames are candidate-major, so candidate j owns frames [j * n, (j + 1) * n)
+        noise_levels = torch.tensor([cand["noise_level"] for cand in candidates], dtype=torch.float, device=device)
+        noise_levels = noise_levels.repeat_interleave(n)[:, None, None, None]
+        step_sizes = torch.tensor([cand["step_size"] for cand in candidates], dtype=torch.float, device=device)[:, None, None, None]
+        losses = np.zeros((k, iterations))
+        stopped_by = "iterations"
+        noise = torch.empty(k * n, *clean_imgs.shape[1:], device=device)
+
+        for i in range(iterations):
+            perturbation = perturbation.detach()
+            perturbation.requires_grad = True
+            imgs = compositor(clean_imgs, perturbation)
+            for cand_noise, (generator, _) in zip(noise.split(n), streams):
+                cand_noise.normal_(generator=generator)
+            noise.div_(noise_levels)
+            if noise_mask is not None:
+                noise.mul_(noise_mask)
+            imgs = torch.clamp(imgs + noise, 0, 1)
+            batches = [(cand_imgs, target) for cand_imgs in imgs.split(n)]
+            if diversification is not None:
+                batches = [diversification(cand_imgs, target, rng) for (cand_imgs, _), (_, rng) in zip(batches, streams)]
+            y = forward(torch.cat([cand_imgs for cand_imgs, _ in batches]))
+            candidate_losses = torch.stack([
+                loss_fxn(cand_y, cand_target)
+                for cand_y, (_, cand_target) in zip(y.split(len(batches[0][0])), batches)
+            ])
+            # candidates do not share texels, so the gradient of the sum is each candidate's own gradient
+            candidate_losses.sum().backward()
+            perturbation = torch.clamp(
+                perturbation - torch.sign(perturbation.grad) * step_sizes, 0, 1
+            )
+            model.zero_grad()
+            losses[:, i] = candidate_losses.detach().cpu().numpy()
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                stopped_by = "deadline"
+                break
+        losses = losses[:, :i + 1]
+        print(
+            f"[iteration {i:5d}/{iterations}] {k} candidates, loss min={losses[:, i].min():2.5f} max={losses[:, i].max():2.5f}"
+        )
+
+        with torch.no_grad():
+            perturbation = perturbation.detach()
+            y = model(compositor(clean_imgs, perturbation))
+            final_losses = torch.stack([loss_fxn(cand_y, target) for cand_y in y.split(n)]).cpu().numpy()
+            best = int(np.argmin(final_losses))
+            self.perturbation = perturbation[best:best + 1]
+            bb = self.split_billboards(self.residency.billboard(self.perturbation), img_patches)
+            pert_angles = y.split(n)[best]
+            orig_angles = self.clean_predictions(model, img_arr, clean_imgs, device)
+            MAE = (orig_angles - pert_angles).mean().cpu()
+            y = pert_angles.cpu().numpy().reshape(n)
+        self.stats = {"iterations": i + 1, "stopped_by": stopped_by, "time": time.perf_counter() - start, "seed": seed}
+        population = {"candidates": candidates, "losses": losses, "final_losses": final_losses, "best": best,
+                      "candidate_seeds": candidate_seeds}
+        return bb, y, MAE, population
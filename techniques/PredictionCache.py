@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+
+class PredictionCache():
+    """Unperturbed predictions of one model, computed once per frame.
+
+    Frames are tracked by identity like in FrameBuffer.sync: the cache
+    holds the outputs for a growing sequence of frames and only runs the
+    model on frames it has not seen yet. The engines read the clean
+    predictions they evaluate against from it, and the simulation loops
+    share the same instance so each collected frame goes through the
+    model exactly once.
+    """
+
+    def __init__(self, model, device=torch.device("cuda")):
+        self.model = model
+        self.device = device
+        # the frame objects the predictions were computed for
+        self.sources = []
+        self.outputs = None
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, index):
+        return self.outputs[index]
+
+    def clear(self):
+        self.sources = []
+        self.outputs = None
+
+    def sync(self, frames, imgs=None):
+        # make the cache hold exactly the predictions for `frames`, returned as an Nx1 tensor; imgs are the frames
+        # already stacked on the device (e.g. FrameBuffer.frames()), otherwise new frames are stacked here
+        n = min(len(frames), len(self.sources))
+        if len(frames) < len(self.sources) or any(a is not b for a, b in zip(frames[:n], self.sources[:n])):
+            self.clear()
+            n = 0
+        if len(frames) > n:
+            if imgs is not None:
+                new = imgs[n:len(frames)]
+            else:
+                new = torch.stack([torch.as_tensor(np.asarray(f)) for f in frames[n:]]).float().to(self.device)
+            with torch.no_grad():
+                outputs = self.model(new.to(self.device)).detach()
+            self.outputs = outputs if n == 0 else torch.cat((self.outputs[:n], outputs))
+            self.sources = self.sources[:n] + list(frames[n:])
+        return self.outputs[:len(frames)] if self.outputs is not None else None
+
+    def append(self, frame):
+        # adds one frame and returns its prediction
+        return self.sync(self.sources + [frame])[-1]
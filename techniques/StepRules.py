@@ -0,0 +1,140 @@
+import math
+
+import torch
+
+
+class ConstantSchedule():
+    def __call__(self, i):
+        return 1.0
+
+    def __repr__(self):
+        return "ConstantSchedule()"
+
+
+class ExponentialDecay():
+    """Multiplies the step size by gamma every `every` iterations."""
+
+    def __init__(self, gamma=0.5, every=100):
+        self.gamma = gamma
+        self.every = every
+
+    def __call__(self, i):
+        return self.gamma ** (i // self.every)
+
+    def __repr__(self):
+        return f"ExponentialDecay(gamma={self.gamma}, every={self.every})"
+
+
+class CosineDecay():
+    """Anneals the step size from 1x to min_factor x over `iterations` iterations."""
+
+    def __init__(self, iterations=400, min_factor=0.1):
+        self.iterations = iterations
+        self.min_factor = min_factor
+
+    def __call__(self, i):
+        t = min(i, self.iterations) / self.iterations
+        return self.min_factor + (1 - self.min_factor) * 0.5 * (1 + math.cos(math.pi * t))
+
+    def __repr__(self):
+        return f"CosineDecay(iterations={self.iterations}, min_factor={self.min_factor})"
+
+
+class StepRule():
+    """Update rule for the billboard texture.
+
+    The engines optimize the tensor returned by init() and composite
+    texture(param) into the frames; after each backward pass they replace
+    param with step(param, param.grad, i). reset() is called at the start
+    of every perturb_images call, so state such as momentum does not leak
+    between calls.
+    """
+
+    name = "step_rule"
+
+    def __init__(self, step_size=0.01, schedule=None):
+        self.step_size = step_size
+        self.schedule = schedule if schedule is not None else ConstantSchedule()
+
+    def lr(self, i):
+        return self.step_size * self.schedule(i)
+
+    def reset(self):
+        pass
+
+    def init(self, perturbation):
+        return perturbation
+
+    def texture(self, param):
+        return param
+
+    def step(self, param, grad, i):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}(step_size={self.step_size}, schedule={self.schedule})"
+
+
+class SignSGD(StepRule):
+    """The fast gradient sign step the engines have always used: clamp(p - step_size * sign(grad), 0, 1)."""
+
+    name = "sign_sgd"
+
+    def step(self, param, grad, i):
+        return torch.clamp(param - torch.sign(grad) * self.lr(i), 0, 1)
+
+
+class MomentumSign(StepRule):
+    """MI-FGSM: sign step along an accumulated, L1-normalized gradient with decay mu."""
+
+    name = "momentum_sign"
+
+    def __init__(self, step_size=0.01, mu=1.0, schedule=None):
+        super().__init__(step_size, schedule)
+        self.mu = mu
+        self.velocity = None
+
+    def reset(self):
+        self.velocity = None
+
+    def step(self, param, grad, i):
+        grad = grad / grad.abs().sum().clamp(min=1e-12)
+        self.velocity = grad if self.velocity is None else self.mu * self.velocity + grad
+        return torch.clamp(param - torch.sign(self.velocity) * self.lr(i), 0, 1)
+
+    def __repr__(self):
+        return f"MomentumSign(step_size={self.step_size}, mu={self.mu}, schedule={self.schedule})"
+
+
+class SigmoidAdam(StepRule):
+    """Adam on unconstrained logits, with texture = sigmoid(logits), so no clamping is needed."""
+
+    name = "sigmoid_adam"
+
+    def __init__(self, step_size=0.1, betas=(0.9, 0.999), eps=1e-8, schedule=None):
+        super().__init__(step_size, schedule)
+        self.betas = betas
+        self.eps = eps
+        self.m, self.v = None, None
+
+    def reset(self):
+        self.m, self.v = None, None
+
+    def init(self, perturbation):
+        return torch.logit(perturbation.clamp(1e-3, 1 - 1e-3))
+
+    def texture(self, param):
+        return torch.sigmoid(param)
+
+    def step(self, param, grad, i):
+        beta1, beta2 = self.betas
+        if self.m is None:
+            self.m, self.v = torch.zeros_like(grad), torch.zeros_like(grad)
+        self.m = beta1 * self.m + (1 - beta1) * grad
+        self.v = beta2 * self.v + (1 - beta2) * grad * grad
+        m_hat = self.m / (1 - beta1 ** (i + 1))
+        v_hat = self.v / (1 - beta2 ** (i + 1))
+        return param - self.lr(i) * m_hat / (v_hat.sqrt() + self.eps)
+
+    def __repr__(self):
+        return f"SigmoidAdam(step_size={self.step_size}, betas={self.betas}, schedule={self.schedule})"
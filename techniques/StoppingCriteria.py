@@ -0,0 +1,117 @@
+import torch
+
+
+class StoppingCriterion():
+    """Ends a perturbation loop early.
+
+    The engines call check() once per iteration, after the backward pass
+    and before the sign step, with the noisy loss, the predicted steering
+    angles, the steering target and the perturbation (whose .grad is set).
+    reset() is called at the start of every perturb_images call.
+    """
+
+    name = "criterion"
+
+    def reset(self):
+        pass
+
+    def check(self, loss, y, target, perturbation, direction):
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ", ".join(f"{k}={v}" for k, v in vars(self).items() if not k.startswith("_"))
+        return f"{type(self).__name__}({params})"
+
+
+class LossPlateau(StoppingCriterion):
+    """Fires when the mean loss of the last window iterations is within tol of the window before it."""
+
+    name = "loss_plateau"
+
+    def __init__(self, window=5, tol=1e-4):
+        self.window = window
+        self.tol = tol
+        self._losses = []
+
+    def reset(self):
+        self._losses = []
+
+    def check(self, loss, y, target, perturbation, direction):
+        self._losses.append(loss.item())
+        if len(self._losses) < 2 * self.window:
+            return False
+        last = sum(self._losses[-self.window:]) / self.window
+        prev = sum(self._losses[-2 * self.window:-self.window]) / self.window
+        return abs(prev - last) < self.tol
+
+
+class Saturation(StoppingCriterion):
+    """Fires when at least fraction of the texels sit at 0 or 1 with the gradient pushing them further out.
+
+    The step is clamped to [0, 1], so those texels would not change anymore.
+    """
+
+    name = "saturation"
+
+    def __init__(self, fraction=0.99):
+        self.fraction = fraction
+
+    def check(self, loss, y, target, perturbation, direction):
+        grad = perturbation.grad
+        if grad is None:
+            return False
+        # the step is perturbation - sign(grad) * step_size
+        stuck = ((perturbation <= 0) & (grad > 0)) | ((perturbation >= 1) & (grad < 0)) | (grad == 0)
+        return stuck.float().mean().item() >= self.fraction
+
+
+class TargetReached(StoppingCriterion):
+    """Fires when at least fraction of the frames steer to the target or beyond, within tol.
+
+    Beyond means further left than the target for direction "left" and
+    further right for "right"; without a direction the prediction has to
+    be within tol of the target.
+    """
+
+    name = "target_reached"
+
+    def __init__(self, tol=0.05, fraction=1.0):
+        self.tol = tol
+        self.fraction = fraction
+
+    def check(self, loss, y, target, perturbation, direction):
+        y = y.detach().flatten()
+        target = torch.as_tensor(target, dtype=y.dtype, device=y.device).expand_as(y)
+        if direction == "left":
+            reached = y <= target + self.tol
+        elif direction == "right":
+            reached = y >= target - self.tol
+        else:
+            reached = (y - target).abs() <= self.tol
+        return reached.float().mean().item() >= self.fraction
+
+
+class LossBelow(StoppingCriterion):
+    """Fires once the (noisy) loss drops to threshold or below."""
+
+    name = "loss_below"
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def check(self, loss, y, target, perturbation, direction):
+        return loss.item() <= self.threshold
+
+
+def reset_all(criteria):
+    for criterion in criteria or []:
+        criterion.reset()
+
+
+def first_fired(criteria, loss, y, target, perturbation, direction):
+    # name of the first criterion that fires, or None; every criterion is checked so they all see each iteration
+    fired = None
+    for criterion in criteria or []:
+        if criterion.check(loss, y, target, perturbation, direction) and fired is None:
+            fired = criterion.name
+    return fired
@@ -0,0 +1,257 @@
+import argparse
+import random
+import sys
+import time
+
+import kornia
+import numpy as np
+import torch
+
+from .Diversifications import RandomAffine, RandomScale
+from .Losses import MDirE
+from .Parameterizations import DCT, ControlGrid, Palette, Pixels
+from .PatchGeometry import PatchGeometryCache
+from .StepRules import CosineDecay, MomentumSign, SigmoidAdam, SignSGD
+from .StoppingCriteria import LossBelow, TargetReached
+from .SuperDeepBillboard import SuperDeepBillboard
+
+# usage: python -m deepbillboard.benchmarks <benchmark> [options]
+
+
+def synthetic_patches(num_frames, height, width, seed=0):
+    # a billboard that grows and drifts towards the left edge as the car approaches it,
+    # rows are [frame_id, x0, y0, x1, y1, x2, y2, x3, y3] like the collected sequences
+    rng = np.random.default_rng(seed)
+    patches = []
+    for i in range(num_frames):
+        s = height / 10 + i * height / (4 * num_frames)
+        x0 = width / 4 - i * width / (8 * num_frames)
+        y0 = height / 4 + rng.uniform(-1, 1)
+        patches.append([i, x0, y0, x0 + s, y0 + s / 10, x0, y0 + s, x0 + s, y0 + 1.1 * s])
+    return np.array(patches)
+
+
+def timeit(fxn, repeats, device):
+    fxn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fxn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def synthetic_frames(num_frames, height, width, seed=0):
+    # a smooth random background with small per-frame jitter, stands in for a collected sequence
+    generator = torch.Generator().manual_seed(seed)
+    base = torch.nn.functional.interpolate(torch.rand(1, 3, height // 8, width // 8, generator=generator),
+                                           size=(height, width), mode="bilinear", align_corners=False)
+    frames = base + 0.02 * torch.randn(num_frames, 3, height, width, generator=generator)
+    return list(frames.clamp(0, 1))
+
+
+def load_model(args, device):
+    if args.model is None:
+        raise SystemExit("this benchmark needs --model")
+    if args.models_src is not None:
+        # torch.load needs the module the model class was saved from
+        sys.path.append(str(args.models_src))
+    return torch.load(args.model, map_location=device).eval()
+
+
+def compositing(args):
+    device = torch.device(args.device)
+    shape = (args.height, args.width)
+    frames = torch.rand(args.frames, 3, *shape, device=device)
+    patches = synthetic_patches(args.frames, *shape)
+    geometry = PatchGeometryCache(device=device)
+    perspective_transforms, warp_masks, inv_masks = geometry.lookup(patches, args.bb_size, shape)
+    compositor = geometry.compositor(patches, args.bb_size, shape)
+    perturbation = torch.rand(1, 3, args.bb_size, args.bb_size, device=device, requires_grad=True)
+
+    def kornia_path():
+        perturbation_warp = kornia.geometry.transform.warp_perspective(
+            torch.vstack([perturbation for _ in range(len(perspective_transforms))]),
+            perspective_transforms,
+            dsize=shape,
+            mode="nearest",
+            align_corners=True
+        )
+        imgs = frames * inv_masks
+        imgs += perturbation_warp * warp_masks
+        imgs.sum().backward()
+        return imgs
+
+    def sparse_path():
+        imgs = compositor(frames, perturbation)
+        imgs.sum().backward()
+        return imgs
+
+    err = (kornia_path() - sparse_path()).abs().max().item()
+    t_kornia = timeit(kornia_path, args.repeats, device)
+    t_sparse = timeit(sparse_path, args.repeats, device)
+    print(f"{args.frames} frames {shape}, {args.bb_size}x{args.bb_size} billboard, "
+          f"{len(compositor.dst) // 3} patch pixels on {device}, max abs diff {err:.2e}")
+    print(f"kornia warp_perspective + masks: {t_kornia * 1000:8.3f} ms/iteration (forward + backward)")
+    print(f"PatchCompositor:                 {t_sparse * 1000:8.3f} ms/iteration (forward + backward)")
+    print(f"speedup: {t_kornia / t_sparse:.1f}x")
+
+
+def step_rules(args):
+    # iterations (one forward/backward pass each) until a fraction of the frames steer to the target
+    device = torch.device(args.device)
+    model = load_model(args, device)
+    frames = synthetic_frames(args.frames, args.height, args.width)
+    patches = synthetic_patches(args.frames, args.height, args.width)
+    steering_vector = torch.full((args.frames,), args.target)
+    rules = [
+        SignSGD(step_size=0.01),
+        SignSGD(step_size=0.05, schedule=CosineDecay(args.iterations, min_factor=0.1)),
+        MomentumSign(step_size=0.01, mu=1.0),
+        SigmoidAdam(step_size=0.1),
+    ]
+    print(f"{args.frames} frames {(args.height, args.width)}, {args.bb_size}x{args.bb_size} billboard, "
+          f"target {args.target} +- {args.tol} on {args.fraction:.0%} of frames, at most {args.iterations} iterations on {device}")
+    for rule in rules:
+        sdbb = SuperDeepBillboard(model, None, args.direction)
+        _, y, MAE = sdbb.perturb_images(frames, patches, model, steering_vector, bb_size=args.bb_size,
+                                        iterations=args.iterations, noise_level=args.noise_level, device=device,
+                                        stopping=[TargetReached(tol=args.tol, fraction=args.fraction)], step_rule=rule,
+                                        seed=args.seed)
+        stats = sdbb.stats
+        reached = stats["stopped_by"] == "target_reached"
+        print(f"{repr(rule):80s} iterations={stats['iterations']:4d} reached={str(reached):5s} "
+              f"time={stats['time']:7.2f}s MAE={float(MAE):.4f} mean(y)={y.mean():.4f}")
+
+
+def diversification(args):
+    device = torch.device(args.device)
+    imgs = torch.rand(args.frames, 3, args.height, args.width, device=device)
+    target = torch.full((args.frames,), args.target, device=device)
+
+    def looped():
+        # the per-frame scale-and-concatenate loop the engines used before RandomAffine
+        imgs_rs, target_exp = imgs, target.clone()
+        for i in range(imgs.shape[0]):
+            r1 = random.randint(0, imgs.shape[0]-1)
+            r2 = random.uniform(0.5, 2.0)
+            temp = kornia.geometry.transform.scale(imgs[r1][None], torch.tensor([[r2]]).float().to(device))
+            imgs_rs = torch.cat((imgs_rs, temp))
+            target_exp = torch.cat((target_exp, target[r1][None]), dim=0)
+        return imgs_rs, target_exp
+
+    t_looped = timeit(looped, args.repeats, device)
+    t_batched = timeit(lambda: RandomScale(0.5, 2.0)(imgs, target), args.repeats, device)
+    t_affine = timeit(lambda: RandomAffine(0.5, 2.0, rotation=5, translation=0.05, brightness=0.2)(imgs, target),
+                      args.repeats, device)
+    print(f"{args.frames} frames {(args.height, args.width)} on {device}")
+    print(f"per-frame scale + cat: {t_looped * 1000:8.3f} ms/iteration")
+    print(f"RandomScale:           {t_batched * 1000:8.3f} ms/iteration")
+    print(f"RandomAffine:          {t_affine * 1000:8.3f} ms/iteration (with rotation, translation and brightness)")
+
+
+def multiscale(args):
+    # wall time until the noisy MDirE loss of a single-scale reference run is reached, single-scale vs coarse-to-fine
+    device = torch.device(args.device)
+    model = load_model(args, device)
+    frames = synthetic_frames(args.frames, args.height, args.width)
+    patches = synthetic_patches(args.frames, args.height, args.width)
+    steering_vector = torch.full((args.frames,), args.target)
+    levels = [int(size) for size in args.levels.split(",")]
+    level_iterations = [int(its) for its in args.level_iterations.split(",")]
+    sdbb = SuperDeepBillboard(model, None, args.direction)
+    sdbb.perturb_images(frames, patches, model, steering_vector, bb_size=args.bb_size, iterations=args.iterations,
+                        noise_level=args.noise_level, device=device, seed=args.seed)
+    threshold = sdbb.stats["loss"]
+    print(f"{args.frames} frames {(args.height, args.width)}, {args.bb_size}x{args.bb_size} billboard on {device}, "
+          f"target MDirE {threshold:.5f} (single-scale after {args.iterations} iterations)")
+    runs = [("single-scale", {}), (f"levels {levels} x {level_iterations}",
+                                   {"levels": levels, "level_iterations": level_iterations})]
+    for label, kwargs in runs:
+        sdbb = SuperDeepBillboard(model, None, args.direction)
+        _, y, MAE = sdbb.perturb_images(frames, patches, model, steering_vector, bb_size=args.bb_size,
+                                        iterations=2 * args.iterations, noise_level=args.noise_level, device=device,
+                                        stopping=[LossBelow(threshold)], seed=args.seed, **kwargs)
+        stats = sdbb.stats
+        reached = stats["stopped_by"] == "loss_below"
+        print(f"{label:40s} iterations={stats['iterations']:4d} reached={str(reached):5s} "
+              f"time={stats['time']:7.2f}s loss={stats['loss']:.5f} MAE={float(MAE):.4f}")
+
+
+def parameterizations(args):
+    # iterations until a fraction of the frames steer to the target, and the MDirE loss of the resulting billboard
+    # under fresh sensor noise at the run's noise level and at twice its standard deviation
+    device = torch.device(args.device)
+    model = load_model(args, device)
+    frames = synthetic_frames(args.frames, args.height, args.width)
+    patches = synthetic_patches(args.frames, args.height, args.width)
+    steering_vector = torch.full((args.frames,), args.target)
+    clean_imgs = torch.stack(frames).to(device)
+    compositor = PatchGeometryCache(device=device).compositor(patches, args.bb_size, (args.height, args.width))
+    loss_fxn = MDirE(args.direction)
+    generator = torch.Generator(device=device)
+
+    def noisy_loss(texture, noise_level):
+        generator.manual_seed(args.seed)
+        losses = []
+        with torch.no_grad():
+            for _ in range(10):
+                imgs = compositor(clean_imgs, texture)
+                noise = torch.empty(imgs.shape, device=device).normal_(0, 1 / noise_level, generator=generator)
+                losses.append(loss_fxn(model(torch.clamp(imgs + noise, 0, 1)), steering_vector.to(device)).item())
+        return sum(losses) / len(losses)
+
+    print(f"{args.frames} frames {(args.height, args.width)}, {args.bb_size}x{args.bb_size} billboard, "
+          f"target {args.target} +- {args.tol} on {args.fraction:.0%} of frames, at most {args.iterations} iterations on {device}")
+    for parameterization in [Pixels(), DCT(coefficients=4), ControlGrid(points=4), Palette(colors=8)]:
+        sdbb = SuperDeepBillboard(model, None, args.direction)
+        _, y, MAE = sdbb.perturb_images(frames, patches, model, steering_vector, bb_size=args.bb_size,
+                                        iterations=args.iterations, noise_level=args.noise_level, device=device,
+                                        stopping=[TargetReached(tol=args.tol, fraction=args.fraction)],
+                                        seed=args.seed, parameterization=parameterization)
+        stats = sdbb.stats
+        reached = stats["stopped_by"] == "target_reached"
+        texture = sdbb.perturbation.to(device)
+        print(f"{repr(parameterization):40s} params={parameterization.num_params(args.bb_size):5d} "
+              f"iterations={stats['iterations']:4d} reached={str(reached):5s} time={stats['time']:7.2f}s "
+              f"MAE={float(MAE):.4f} noisy MDirE={noisy_loss(texture, args.noise_level):.4f} "
+              f"at 2x noise={noisy_loss(texture, args.noise_level / 2):.4f}")
+
+
+BENCHMARKS = {
+    "compositing": compositing,
+    "diversification": diversification,
+    "multiscale": multiscale,
+    "parameterizations": parameterizations,
+    "step-rules": step_rules,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--height", type=int, default=135)
+    parser.add_argument("--width", type=int, default=240)
+    parser.add_argument("--bb-size", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--models-src", type=str, default=None, help="directory containing DAVE2pytorch.py")
+    parser.add_argument("--direction", type=str, choices=["left", "right"], default="left")
+    parser.add_argument("--target", type=float, default=-0.15)
+    parser.add_argument("--tol", type=float, default=0.05)
+    parser.add_argument("--fraction", type=float, default=0.8)
+    parser.add_argument("--iterations", type=int, default=400)
+    parser.add_argument("--noise-level", type=float, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--levels", type=str, default="2,4", help="comma-separated coarse billboard sizes")
+    parser.add_argument("--level-iterations", type=str, default="25,25", help="iterations per coarse level")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)